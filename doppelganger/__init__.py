@@ -7,10 +7,11 @@ from .config import Configuration
 from .datasource import PumsData, CleanedData, DirtyDataSource
 from .marginals import Marginals
 from .preprocessing import Preprocessor
-from .populationgen import Population
+from .populationgen import LazyPopulation, Population
 
 # Enumerate exports, to make the linter happy.
 __all__ = [
     Accuracy, HouseholdAllocator, SegmentedData, BayesianNetworkModel, Configuration,
     PumsData, CleanedData, Marginals, Population, Preprocessor, DirtyDataSource,
+    LazyPopulation,
 ]
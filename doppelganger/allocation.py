@@ -4,14 +4,18 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
-from collections import defaultdict, namedtuple
+from collections import namedtuple, OrderedDict
+import json
 import numpy as np
 import pandas
+import scipy.sparse
 
 from doppelganger.listbalancer import (
-    balance_multi_cvx, discretize_multi_weights
+    Multipliers, SolveReport, balance_multi_cvx, balance_multi_decomposed, balance_multi_dual,
+    balance_multi_ipf, collapse_household_types, discretize_multi_weights,
+    discretize_multi_weights_trs, expand_household_types, scale_weights
 )
-from doppelganger import inputs
+from doppelganger import columnar, compression as compressed, inputs
 
 
 HIGH_PASS_THRESHOLD = .1  # Filter controls which are present in less than 10% of HHs
@@ -35,29 +39,186 @@ DEFAULT_HOUSEHOLD_FIELDS = {
 }
 
 
+# Methods balancing household weights across tracts, by name
+BALANCERS = {
+    'cvx': balance_multi_cvx,
+    'decomposed': balance_multi_decomposed,
+    'dual': balance_multi_dual,
+    'ipf': balance_multi_ipf,
+}
+
+# Balancers returning the multipliers of their solution, and those of them
+# which can start from earlier multipliers
+MULTIPLIER_BALANCERS = {'cvx', 'decomposed', 'dual', 'ipf'}
+WARM_START_BALANCERS = {'decomposed', 'dual', 'ipf'}
+
+# Methods rounding balanced household weights to integers, by name
+DISCRETIZERS = {
+    'lp': discretize_multi_weights,
+    'trs': discretize_multi_weights_trs,
+}
+
 CountInformation = namedtuple('CountInformation', ['tract', 'count'])
 
 
+class SerialNumberIndex(object):
+    """CSR-style index from serial numbers to the rows holding them.
+
+    Rows are sorted by serial number (stably, so each serial number's rows
+    keep their order) and `offsets[i]:offsets[i + 1]` of `rows` are the rows
+    of `serialnos[i]`.
+
+    Args:
+        serialnos (numpy array): serial number of each row
+    """
+
+    def __init__(self, serialnos):
+        serialnos = np.asarray(serialnos)
+        self.rows = np.argsort(serialnos, kind='mergesort')
+        sorted_serialnos = serialnos[self.rows]
+        starts = np.flatnonzero(np.concatenate((
+            [True], sorted_serialnos[1:] != sorted_serialnos[:-1]))) if len(serialnos) else \
+            np.array([], dtype=int)
+        self.serialnos = sorted_serialnos[starts]
+        self.offsets = np.append(starts, len(serialnos))
+
+    def lookup(self, serialno):
+        """Return the rows of a serial number, in their original order"""
+        i = np.searchsorted(self.serialnos, serialno)
+        if i == len(self.serialnos) or self.serialnos[i] != serialno:
+            return self.rows[:0]
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def lookup_many(self, serialnos):
+        """Return the rows of many serial numbers at once.
+
+        Args:
+            serialnos (numpy array): serial numbers to look up
+
+        Returns:
+            (numpy array, numpy array): position in `serialnos` and row of
+                each match, ordered by position then row
+        """
+        serialnos = np.asarray(serialnos)
+        if not len(self.serialnos) or not len(serialnos):
+            return np.array([], dtype=int), self.rows[:0]
+        indexes = np.minimum(np.searchsorted(self.serialnos, serialnos), len(self.serialnos) - 1)
+        found = self.serialnos[indexes] == serialnos
+        starts = self.offsets[indexes]
+        lengths = np.where(found, self.offsets[indexes + 1] - starts, 0)
+        positions = np.repeat(np.arange(len(serialnos)), lengths)
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return positions, self.rows[np.repeat(starts, lengths) + within]
+
+
+class TractMultipliers(namedtuple('TractMultipliers', ['tracts', 'controls', 'lambdas', 'nus'])):
+    """Multipliers of an allocation's balancing solve, labeled by tract and control.
+
+    They only depend on tracts and controls, not on households, so they warm
+    start allocations with revised marginals, other PUMS data or gamma.
+
+    Attributes:
+        tracts (numpy array): tract of each row of lambdas
+        controls (numpy array): control of each column of lambdas and of nus
+        lambdas (numpy array): marginal multipliers, tracts by controls
+        nus (numpy array): meta-marginal multipliers
+    """
+
+    @staticmethod
+    def from_file(infile):
+        """Load multipliers saved by `write`"""
+        with np.load(infile) as data:
+            return TractMultipliers(
+                data['tracts'], data['controls'], data['lambdas'], data['nus'])
+
+    def write(self, outfile):
+        """Save the multipliers to a NumPy .npz file"""
+        np.savez(
+            outfile, tracts=np.asarray(self.tracts, dtype=str),
+            controls=np.asarray(self.controls, dtype=str), lambdas=self.lambdas, nus=self.nus)
+
+    def align(self, tracts, controls):
+        """Multipliers for the given tracts and controls, zero where unknown
+
+        Returns:
+            Multipliers: tracts by controls lambdas and nus
+        """
+        tract_positions = pandas.Index(np.asarray(self.tracts, dtype=str)).get_indexer(
+            np.asarray(tracts, dtype=str))
+        control_positions = pandas.Index(np.asarray(self.controls, dtype=str)).get_indexer(
+            np.asarray(controls, dtype=str))
+        known_tracts = tract_positions >= 0
+        known_controls = control_positions >= 0
+        lambdas = np.zeros((len(tracts), len(controls)))
+        lambdas[np.ix_(known_tracts, known_controls)] = self.lambdas[np.ix_(
+            tract_positions[known_tracts], control_positions[known_controls])]
+        nus = np.zeros(len(controls))
+        nus[known_controls] = self.nus[control_positions[known_controls]]
+        return Multipliers(lambdas, nus)
+
+
 class HouseholdAllocator(object):
 
     @staticmethod
-    def from_csvs(households_csv, persons_csv):
+    def from_csvs(households_csv, persons_csv, compression='infer', multipliers_file=None):
         """Load saved household and person allocations.
 
         Args:
             households_csv (unicode): path to households file
             persons_csv (unicode): path to persons file
+            compression (unicode): 'gzip', 'bz2', None or 'infer' from the
+                file extension
+            multipliers_file (unicode): optional path to the multipliers
+                saved with the allocation, see `write`
 
         Returns:
             HouseholdAllocator: allocated persons & households_csv
 
         """
-        allocated_households = pandas.read_csv(households_csv)
-        allocated_persons = pandas.read_csv(persons_csv)
-        return HouseholdAllocator(allocated_households, allocated_persons)
+        allocated_households = pandas.read_csv(households_csv, compression=compression)
+        allocated_persons = pandas.read_csv(persons_csv, compression=compression)
+        return HouseholdAllocator(
+            allocated_households, allocated_persons,
+            HouseholdAllocator._read_multipliers(multipliers_file))
+
+    @staticmethod
+    def from_parquet(households_file, persons_file, household_columns=None, tracts=None,
+                     multipliers_file=None):
+        """Load household and person allocations saved by `write_parquet`.
+
+        Args:
+            households_file (unicode): path to households Parquet file
+            persons_file (unicode): path to persons Parquet file
+            household_columns (iterable(unicode)): optional household columns
+                to load.  The serial number, tract and count are always loaded.
+            tracts (iterable): optional tracts to load, defaults to all
+            multipliers_file (unicode): optional path to the multipliers
+                saved with the allocation, see `write_parquet`
+
+        Returns:
+            HouseholdAllocator: allocated persons & households
+
+        """
+        if household_columns is not None:
+            required = [inputs.SERIAL_NUMBER.name, inputs.TRACT.name, inputs.COUNT.name]
+            household_columns = required + [
+                column for column in household_columns if column not in required]
+        allocated_households = columnar.read_parquet(households_file, household_columns, tracts)
+        allocated_persons = columnar.read_parquet(persons_file)
+        return HouseholdAllocator(
+            allocated_households, allocated_persons,
+            HouseholdAllocator._read_multipliers(multipliers_file))
 
     @staticmethod
-    def from_cleaned_data(marginals, households_data, persons_data):
+    def _read_multipliers(multipliers_file):
+        """Load TractMultipliers if a file is given"""
+        if multipliers_file is None:
+            return None
+        return TractMultipliers.from_file(multipliers_file)
+
+    @staticmethod
+    def from_cleaned_data(marginals, households_data, persons_data, sample_fraction=1.,
+                          balancer='cvx', discretizer='lp', multipliers=None):
         """Allocate households based on the given data.
 
         marginals (Marginals): controls to match when allocating
@@ -65,7 +226,33 @@ class HouseholdAllocator(object):
             DEFAULT_HOUSEHOLD_FIELDS.
         persons_data (CleanedData): data about persons.  Must contain
             DEFAULT_PERSON_FIELDS.
+        sample_fraction (float): optional fraction to scale the allocated
+            counts by, see `sample`
+        balancer (unicode): name of the method balancing household weights,
+            one of BALANCERS.  'decomposed' solves blocks of tracts in
+            parallel, coordinated through the meta-marginal multipliers, for
+            PUMAs with many tracts, 'ipf' uses iterative
+            proportional fitting and 'dual' L-BFGS-B on the dual problem
+            instead of a conic solver.
+        discretizer (unicode): name of the method rounding balanced weights to
+            integers, one of DISCRETIZERS.  'lp' solves a linear program
+            fitting the marginals, 'trs' rounds by systematic sampling in
+            milliseconds, unbiased for household weights and tract totals.
+        multipliers (TractMultipliers): optional multipliers of an earlier
+            allocation to start balancing from, see `multipliers`.  Needs a
+            balancer in WARM_START_BALANCERS.
         """
+        if balancer not in BALANCERS:
+            raise ValueError('Unknown balancer {}, expected one of {}'.format(
+                balancer, sorted(BALANCERS)))
+        if discretizer not in DISCRETIZERS:
+            raise ValueError('Unknown discretizer {}, expected one of {}'.format(
+                discretizer, sorted(DISCRETIZERS)))
+        if multipliers is not None and balancer not in WARM_START_BALANCERS:
+            names = ["'{}'".format(name) for name in sorted(WARM_START_BALANCERS)]
+            raise ValueError(
+                'Balancer {} cannot start from multipliers, use balancer={} or {} instead'.format(
+                    balancer, ', '.join(names[:-1]), names[-1]))
         for field in DEFAULT_HOUSEHOLD_FIELDS:
             assert field.name in households_data.data, \
                 'Missing required field {}'.format(field.name)
@@ -75,20 +262,38 @@ class HouseholdAllocator(object):
 
         households, persons = HouseholdAllocator._format_data(
             households_data.data, persons_data.data)
-        allocated_households, allocated_persons = \
-            HouseholdAllocator._allocate_households(households, persons, marginals)
-        return HouseholdAllocator(allocated_households, allocated_persons)
-
-    def __init__(self, allocated_households, allocated_persons):
+        allocated_households, allocated_persons, tract_multipliers, reports = \
+            HouseholdAllocator._allocate_households(
+                households, persons, marginals, balancer, discretizer, multipliers)
+        allocator = HouseholdAllocator(
+            allocated_households, allocated_persons, tract_multipliers)
+        allocator.reports = reports
+        if sample_fraction != 1:
+            allocator = allocator.sample(sample_fraction)
+        return allocator
+
+    def __init__(self, allocated_households, allocated_persons, multipliers=None):
 
         self.allocated_households = allocated_households
         self.allocated_persons = allocated_persons
-        self.serialno_to_counts = defaultdict(list)
-        for _, row in self.allocated_households.iterrows():
-            serialno = row[inputs.SERIAL_NUMBER.name]
-            tract = row[inputs.TRACT.name]
-            count = int(row[inputs.COUNT.name])
-            self.serialno_to_counts[serialno].append(CountInformation(tract, count))
+        # TractMultipliers of the balancing solve, if known
+        self.multipliers = multipliers
+        # SolveReports of the allocation steps by name, if allocated in this run
+        self.reports = OrderedDict()
+        # Built on first use, see _counts_index
+        self._serialno_index = None
+
+    def _counts_index(self):
+        """Return the serial number index of the allocated households, with
+        their tracts and counts"""
+        if self._serialno_index is None:
+            households = self.allocated_households
+            self._serialno_index = (
+                SerialNumberIndex(households[inputs.SERIAL_NUMBER.name].values),
+                np.asarray(households[inputs.TRACT.name].values),
+                np.asarray(households[inputs.COUNT.name].values).astype(int),
+            )
+        return self._serialno_index
 
     def get_counts(self, serialno):
         """Return the information about weights for a given serial number.
@@ -96,7 +301,7 @@ class HouseholdAllocator(object):
         A household is repeated for a certain number of times for each tract.
         This returns a list of (tract, repeat count).  The repeat count
         indicates the number of times this serial number should be repeated in
-        this tract.
+        this tract.  See `get_counts_bulk` to look up many serial numbers.
 
         Args:
             seriano (unicode): the household's serial number
@@ -104,18 +309,98 @@ class HouseholdAllocator(object):
         Returns:
             list(CountInformation): the weighted repetitions for this serialno
         """
-        return self.serialno_to_counts[serialno]
+        index, tracts, counts = self._counts_index()
+        rows = index.lookup(serialno)
+        return [CountInformation(tract, int(count))
+                for tract, count in zip(tracts[rows], counts[rows])]
+
+    def get_counts_bulk(self, serialnos):
+        """Return the weights of many serial numbers at once.
+
+        Args:
+            serialnos (numpy array): serial numbers to look up
+
+        Returns:
+            (numpy array, numpy array, CountInformation): for each (serialno,
+                tract) match, the position in `serialnos`, the row in
+                `allocated_households` and arrays of the tract and repeat count
+        """
+        index, tracts, counts = self._counts_index()
+        positions, rows = index.lookup_many(serialnos)
+        return positions, rows, CountInformation(tracts[rows], counts[rows])
+
+    def sample(self, fraction, random_state=None):
+        """Scale the allocated counts by a sampling fraction, e.g. for quick prototyping runs.
+
+        Counts are rounded randomly without bias, so the expected count of
+        every household in every tract is `fraction` times its full count.
+
+        Args:
+            fraction (float): sampling fraction, e.g. 0.01 for a 1% population
+            random_state (numpy.random.RandomState): optional source of randomness
 
-    def write(self, household_file, person_file):
+        Returns:
+            HouseholdAllocator: allocation with the scaled counts
+        """
+        allocated_households = self.allocated_households.copy()
+        allocated_households[inputs.COUNT.name] = scale_weights(
+            allocated_households[inputs.COUNT.name].values, fraction, random_state)
+        allocator = HouseholdAllocator(
+            allocated_households, self.allocated_persons, self.multipliers)
+        allocator.reports = self.reports
+        return allocator
+
+    def write(self, household_file, person_file, compression=None, multipliers_file=None):
         """Write allocated households and persons to the given files
 
         Args:
             household_file (unicode): path to write households to
             person_file (unicode): path to write persons to
+            compression (unicode): optional 'gzip' or 'bz2' (Python 3 only),
+                compressed in blocks on a thread pool
+            multipliers_file (unicode): optional path to save the multipliers
+                to, so a reloaded allocation can warm start another one.
+                They are not part of the households and persons files.
+
+        """
+        compressed.to_csv(self.allocated_households, household_file, compression)
+        compressed.to_csv(self.allocated_persons, person_file, compression)
+        self._write_multipliers(multipliers_file)
+
+    def _write_multipliers(self, multipliers_file):
+        """Save the multipliers if a file is given"""
+        if multipliers_file is None:
+            return
+        if self.multipliers is None:
+            raise ValueError('Allocation has no multipliers to write')
+        self.multipliers.write(multipliers_file)
+
+    def write_reports(self, outfile):
+        """Write the solve reports of the allocation steps to a JSON file
+
+        Args:
+            outfile (unicode): path to write the reports to
+        """
+        with open(outfile, 'w') as output:
+            json.dump(OrderedDict(
+                (name, report.to_dict()) for name, report in self.reports.items()
+            ), output, indent=2, allow_nan=False)
+
+    def write_parquet(self, household_file, person_file, multipliers_file=None):
+        """Write allocated households and persons to Parquet files
+
+        Households are stored with one row group per tract.
+
+        Args:
+            household_file (unicode): path to write households to
+            person_file (unicode): path to write persons to
+            multipliers_file (unicode): optional path to save the multipliers
+                to, see `write`
 
         """
-        self.allocated_households.to_csv(household_file)
-        self.allocated_persons.to_csv(person_file)
+        columnar.write_parquet(self.allocated_households, household_file)
+        columnar.write_parquet(self.allocated_persons, person_file)
+        self._write_multipliers(multipliers_file)
 
     @staticmethod
     def _filter_sparse_columns(df, cols):
@@ -133,7 +418,37 @@ class HouseholdAllocator(object):
             .columns.tolist()
 
     @staticmethod
-    def _allocate_households(households, persons, tract_controls):
+    def _incidence_matrix(households, columns):
+        """Sparse household by control table of the indicator columns
+
+        Each household falls in a single bin of each allocation input, so
+        the table is mostly zeros.
+
+        Args:
+            households (pandas.DataFrame): households with indicator columns
+            columns (list(str)): indicator columns, in control order
+
+        Returns:
+            scipy.sparse.csr_matrix: households by controls
+        """
+        rows = []
+        cols = []
+        values = []
+        for col, name in enumerate(columns):
+            column = households[name].values
+            nonzero = np.flatnonzero(column)
+            rows.append(nonzero)
+            cols.append(np.full(len(nonzero), col, dtype=int))
+            values.append(column[nonzero].astype(float))
+        shape = (len(households), len(columns))
+        if not columns:
+            return scipy.sparse.csr_matrix(shape)
+        return scipy.sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=shape)
+
+    @staticmethod
+    def _allocate_households(households, persons, tract_controls, balancer='cvx',
+                             discretizer='lp', multipliers=None):
 
         # Only take nonzero weights
         households = households[households[inputs.HOUSEHOLD_WEIGHT.name] > 0]
@@ -150,7 +465,7 @@ class HouseholdAllocator(object):
 
         hh_columns = HouseholdAllocator._filter_sparse_columns(households, hh_columns)
 
-        hh_table = households[hh_columns].as_matrix()
+        hh_table = HouseholdAllocator._incidence_matrix(households, hh_columns)
 
         A = tract_controls.data[hh_columns].as_matrix()
         n_tracts, n_controls = A.shape
@@ -172,15 +487,39 @@ class HouseholdAllocator(object):
         # Meta-balancing coefficient
         meta_gamma = 100.
 
-        hh_weights = balance_multi_cvx(
-            hh_table, A, B, w_extend, gamma * mu_extend.T, meta_gamma
-        )
-
         # We're running discretization independently for each tract
         tract_ids = tract_controls.data['TRACTCE'].values
+
+        balancer_options = {}
+        if balancer in MULTIPLIER_BALANCERS:
+            balancer_options['full_output'] = True
+        if multipliers is not None:
+            balancer_options['multipliers'] = multipliers.align(tract_ids, hh_columns)
+
+        reports = OrderedDict((name, SolveReport()) for name in ('balance', 'discretize'))
+        for report in reports.values():
+            report.tracts = tract_ids
+            report.controls = hh_columns
+
+        # Households with the same controls are balanced as one type
+        type_table, type_w, types = collapse_household_types(hh_table, w_extend)
+        # There are few household types, and a dense table lets
+        # balance_multi_cvx reuse its compiled problem of this shape
+        type_table = type_table.toarray()
+        type_weights = BALANCERS[balancer](
+            type_table, A, B, type_w, gamma * mu_extend.T, meta_gamma,
+            report=reports['balance'], **balancer_options
+        )
+        tract_multipliers = None
+        if balancer in MULTIPLIER_BALANCERS:
+            type_weights, solved = type_weights
+            tract_multipliers = TractMultipliers(
+                tract_ids, np.asarray(hh_columns), solved.lambdas, solved.nus)
+        hh_weights = expand_household_types(type_weights, w_extend, types)
         total_weights = np.zeros(hh_weights.shape)
         sample_weights_int = hh_weights.astype(int)
-        discretized_hh_weights = discretize_multi_weights(hh_table, hh_weights)
+        discretized_hh_weights = DISCRETIZERS[discretizer](
+            hh_table, hh_weights, report=reports['discretize'])
         total_weights = sample_weights_int + discretized_hh_weights
 
         # Extend households and add the weights and ids
@@ -189,7 +528,7 @@ class HouseholdAllocator(object):
         tracts = np.repeat(tract_ids, n_samples)
         households_extend[inputs.TRACT.name] = tracts
 
-        return households_extend, persons
+        return households_extend, persons, tract_multipliers, reports
 
     @staticmethod
     def _str_broadcast(string, list1):
@@ -19,16 +19,169 @@ from builtins import range, str
 from collections import defaultdict, Counter
 import json
 import itertools
+import re
 import sys
 
 import pandas
 from pomegranate import BayesianNetwork
 
 
+# Size of the blocks read when streaming a model file
+STREAM_CHUNK_SIZE = 1 << 20
+
+
 def default_segmenter(x):
     return 'one_segment'
 
 
+class _JsonStreamReader(object):
+    """Incremental reader for a json document stored in a file.
+
+    Only the part of the document currently being parsed is held in memory, so
+    large multi-segment models can be read one segment at a time.  Values can
+    be decoded, returned as raw json text or skipped without being decoded.
+    """
+
+    _WHITESPACE = re.compile(r'\s*')
+    _STRUCTURE = re.compile(r'["{}\[\]]')
+    _STRING_END = re.compile(r'["\\]')
+
+    def __init__(self, infile, chunk_size=STREAM_CHUNK_SIZE):
+        self.infile = infile
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.exhausted = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Read more data into the buffer, discarding what has been consumed.
+
+        Returns:
+            bool: whether any data was read
+        """
+        if self.exhausted:
+            return False
+        # Grow reads with the buffer so long values are found in few passes
+        data = self.infile.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not data:
+            self.exhausted = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = self._WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of json document')
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('Expected {!r} at position {} of json document'.format(
+                char, self.pos))
+        self.pos += 1
+
+    def decode_value(self):
+        """Decode the next json value."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number running up to the end of the buffer may be truncated
+            if end < len(self.buffer) or not self._fill():
+                self.pos = end
+                return value
+
+    def _scan_value(self, keep):
+        """Find the end of the next json value without decoding it.
+
+        Args:
+            keep (bool): whether to collect the text of the value
+
+        Returns:
+            unicode: the raw value if `keep`, otherwise None
+        """
+        if self._peek() not in '{[':
+            value = self.decode_value()
+            return json.dumps(value) if keep else None
+        pieces = []
+        depth = 0
+        in_string = False
+        start = self.pos
+        while True:
+            if in_string:
+                match = self._STRING_END.search(self.buffer, self.pos)
+            else:
+                match = self._STRUCTURE.search(self.buffer, self.pos)
+            if match is None or (in_string and match.group() == '\\' and
+                                 match.end() == len(self.buffer)):
+                # Need more data; keep or drop what has been scanned so far.
+                # An escape at the end of the buffer is rescanned after reading.
+                cut = len(self.buffer) if match is None else match.start()
+                if keep:
+                    pieces.append(self.buffer[start:cut])
+                self.pos = cut
+                if not self._fill():
+                    raise ValueError('Unexpected end of json document')
+                start = self.pos
+                continue
+            char = match.group()
+            self.pos = match.end()
+            if in_string:
+                if char == '\\':
+                    # Skip the escaped character
+                    self.pos += 1
+                else:
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    if keep:
+                        pieces.append(self.buffer[start:self.pos])
+                        return ''.join(pieces)
+                    return None
+
+    def raw_value(self):
+        """Return the text of the next json value."""
+        return self._scan_value(keep=True)
+
+    def skip_value(self):
+        """Move past the next json value."""
+        self._scan_value(keep=False)
+
+    def iter_keys(self):
+        """Iterate over the keys of the next json object.
+
+        The caller must consume each key's value before advancing the iterator.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode_value()
+            self._expect(':')
+            yield key
+            char = self._peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError('Expected \',\' or \'}\' in json object')
+
+
 class SegmentedData(object):
     """Segmented data for use with the segemented BayesianNetworkModel.
 
@@ -82,10 +235,41 @@ class BayesianNetworkModel(object):
         self.segmenter = segmenter or default_segmenter
 
     @staticmethod
-    def from_file(filename, segmenter=None):
+    def from_file(filename, segmenter=None, segments=None):
+        """Load a model written by `write`.
+
+        The file is parsed incrementally and each segment's network is built as
+        soon as it is read, so the whole document is never held in memory.
+
+        Args:
+            filename (unicode): path to the model file
+            segmenter: function mapping a row of data to a segment
+            segments (iterable(unicode)): optional segment names to load, as
+                stored in the file.  Other segments are skipped without being
+                parsed.  Defaults to all segments.
+
+        Returns:
+            BayesianNetworkModel: generative model equivalent to stored model
+        """
+        segments = set(segments) if segments is not None else None
+        fields = None
+        type_to_network = {}
         with open(filename) as infile:
-            json_string = infile.read()
-            return BayesianNetworkModel.from_json(json_string, segmenter)
+            reader = _JsonStreamReader(infile)
+            for key in reader.iter_keys():
+                if key == 'fieldnames':
+                    fields = list(reader.decode_value())
+                elif key == 'type_to_network':
+                    for type_ in reader.iter_keys():
+                        if segments is not None and type_ not in segments:
+                            reader.skip_value()
+                            continue
+                        type_to_network[type_] = BayesianNetwork.from_json(reader.raw_value())
+                else:
+                    reader.skip_value()
+        if fields is None:
+            raise ValueError('Model file {} is missing fieldnames'.format(filename))
+        return BayesianNetworkModel(type_to_network, fields, segmenter)
 
     def write(self, outfilename):
         with open(outfilename, 'w') as outfile:
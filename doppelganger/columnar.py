@@ -0,0 +1,224 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Columnar (Parquet and Arrow IPC) storage for allocations and generated populations.
+
+Requires the optional pyarrow dependency, e.g. `pip install doppelganger[parquet]`.
+
+Files are written with one row group per tract and string columns stored as
+categoricals, so readers can load only the columns and tracts they need.
+Streams are written in the Arrow IPC stream format, one record batch per
+DataFrame, so consumers can process each batch as soon as it arrives.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import io
+
+import numpy as np
+import pandas
+
+from doppelganger import inputs
+
+
+def _import_parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            'Parquet support requires pyarrow. Install it with `pip install doppelganger[parquet]`'
+        )
+    return pyarrow, pyarrow.parquet
+
+
+def _as_categorical(dataframe, exclude=()):
+    """Convert the string columns of a DataFrame to categoricals.
+
+    Excluded columns are converted to plain values if they are categorical.
+    """
+    dataframe = dataframe.copy()
+    for name in dataframe.columns:
+        is_categorical = dataframe[name].dtype.name == 'category'
+        if name in exclude and is_categorical:
+            dataframe[name] = np.asarray(dataframe[name])
+        elif name not in exclude and dataframe[name].dtype == object:
+            dataframe[name] = dataframe[name].astype('category')
+    return dataframe
+
+
+def write_parquet(dataframe, path, tract_column=inputs.TRACT.name):
+    """Write a DataFrame to a Parquet file, one row group per tract.
+
+    Args:
+        dataframe (pandas.DataFrame): data to write
+        path (unicode): path of the Parquet file
+        tract_column (unicode): column to split row groups by, if present
+    """
+    pyarrow, parquet = _import_parquet()
+    # Tracts stay plain strings: the row group statistics of dictionary
+    # encoded columns describe the whole dictionary, which defeats pruning.
+    dataframe = _as_categorical(dataframe.reset_index(drop=True), exclude=(tract_column,))
+    schema = pyarrow.Schema.from_pandas(dataframe, preserve_index=False)
+
+    if tract_column in dataframe and len(dataframe):
+        tract_codes, _ = pandas.factorize(dataframe[tract_column].values)
+        order = np.argsort(tract_codes, kind='mergesort')
+        boundaries = np.cumsum(np.bincount(tract_codes))
+        starts = np.concatenate(([0], boundaries[:-1]))
+        row_groups = [order[start:end] for start, end in zip(starts, boundaries)]
+    else:
+        row_groups = [np.arange(len(dataframe))]
+
+    writer = parquet.ParquetWriter(path, schema)
+    try:
+        for rows in row_groups:
+            table = pyarrow.Table.from_pandas(
+                dataframe.iloc[rows], schema=schema, preserve_index=False)
+            writer.write_table(table)
+    finally:
+        writer.close()
+
+
+def read_parquet(path, columns=None, tracts=None, tract_column=inputs.TRACT.name):
+    """Read a Parquet file written by `write_parquet`.
+
+    Args:
+        path (unicode): path of the Parquet file
+        columns (iterable(unicode)): optional columns to read, defaults to all
+        tracts (iterable): optional tracts to read, defaults to all.  Row groups
+            whose statistics exclude these tracts are not read.
+        tract_column (unicode): column holding the tract
+
+    Returns:
+        pandas.DataFrame: the requested rows and columns
+    """
+    _, parquet = _import_parquet()
+    parquet_file = parquet.ParquetFile(path)
+    names = parquet_file.schema.names
+    read_columns = list(columns) if columns is not None else list(names)
+    row_groups = list(range(parquet_file.num_row_groups))
+
+    if tracts is not None:
+        tracts = set(str(tract) for tract in tracts)
+        if tract_column not in read_columns:
+            read_columns.append(tract_column)
+        tract_index = names.index(tract_column)
+
+        def may_contain(row_group):
+            statistics = parquet_file.metadata.row_group(row_group).column(tract_index).statistics
+            if statistics is None or not statistics.has_min_max:
+                return True
+            if statistics.min != statistics.max:
+                return True
+            # Files written by write_parquet hold one tract per row group
+            return str(statistics.min) in tracts
+
+        row_groups = [row_group for row_group in row_groups if may_contain(row_group)]
+
+    if row_groups:
+        dataframe = parquet_file.read_row_groups(row_groups, columns=read_columns).to_pandas()
+    else:
+        dataframe = parquet_file.schema.to_arrow_schema().empty_table().to_pandas()
+        dataframe = dataframe[read_columns]
+
+    if tracts is not None:
+        dataframe = dataframe[dataframe[tract_column].astype(str).isin(tracts)]
+        if columns is not None and tract_column not in columns:
+            dataframe = dataframe.drop(tract_column, axis=1)
+        dataframe = dataframe.reset_index(drop=True)
+    return _as_categorical(dataframe)
+
+
+def _open_sink(sink):
+    """Open a path, file descriptor, socket or file-like object for binary writing.
+
+    Returns:
+        (file-like, bool): the writable file and whether it should be closed
+            with the stream
+    """
+    if isinstance(sink, int):
+        return io.open(sink, 'wb', closefd=False), True
+    if hasattr(sink, 'sendall') and hasattr(sink, 'makefile'):
+        return sink.makefile('wb'), True
+    if hasattr(sink, 'write'):
+        return sink, False
+    return io.open(sink, 'wb'), True
+
+
+def _stream_schema(schema):
+    """Widen integer and dictionary index types, so every batch of a stream fits one schema.
+
+    Generated chunks pick the narrowest types for their own values, which
+    may differ from chunk to chunk.
+    """
+    pyarrow, _ = _import_parquet()
+    fields = []
+    for field in schema:
+        field_type = field.type
+        if pyarrow.types.is_dictionary(field_type):
+            field_type = pyarrow.dictionary(pyarrow.int32(), field_type.value_type)
+        elif pyarrow.types.is_integer(field_type):
+            field_type = pyarrow.int64()
+        fields.append(pyarrow.field(field.name, field_type))
+    return pyarrow.schema(fields)
+
+
+class ArrowStreamWriter(object):
+    """Write DataFrames as record batches of an Arrow IPC stream.
+
+    The schema is taken from the first DataFrame written.  Categorical columns
+    are sent as dictionaries, which may change from batch to batch.
+
+    Args:
+        sink: path, file descriptor, socket or binary file-like object.  File
+            descriptors and sockets are flushed but not closed.
+    """
+
+    def __init__(self, sink):
+        self.pyarrow, _ = _import_parquet()
+        self.outfile, self.close_outfile = _open_sink(sink)
+        self.schema = None
+        self.writer = None
+
+    def write(self, dataframe):
+        """Send the rows of a DataFrame as one record batch"""
+        if self.writer is None:
+            self.schema = _stream_schema(
+                self.pyarrow.Schema.from_pandas(dataframe, preserve_index=False))
+            self.writer = self.pyarrow.ipc.new_stream(self.outfile, self.schema)
+        batch = self.pyarrow.RecordBatch.from_pandas(
+            dataframe, schema=self.schema, preserve_index=False)
+        self.writer.write_batch(batch)
+        self.outfile.flush()
+
+    def close(self):
+        """End the stream"""
+        if self.writer is not None:
+            self.writer.close()
+        self.outfile.flush()
+        if self.close_outfile:
+            self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_arrow_stream(source):
+    """Read the record batches of an Arrow IPC stream written by `ArrowStreamWriter`.
+
+    Args:
+        source: path or binary file-like object
+
+    Yields:
+        pandas.DataFrame: the rows of each record batch
+    """
+    pyarrow, _ = _import_parquet()
+    if not hasattr(source, 'read'):
+        source = pyarrow.OSFile(source)
+    for batch in pyarrow.ipc.open_stream(source):
+        yield batch.to_pandas()
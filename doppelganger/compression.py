@@ -0,0 +1,131 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Compressed csv output, compressed in blocks on a thread pool.
+
+Written text is cut into blocks which are compressed independently into
+concatenated gzip members or bz2 streams.  Concatenated gzip members are a
+standard gzip file.  A multi-stream bz2 file is read whole by bzip2 and by
+Python 3's bz2 module, but Python 2's bz2 module, and pandas on Python 2,
+stop after the first stream, so bz2 output needs Python 3.  zlib and bz2
+release the GIL, so compression overlaps with whatever produces the text.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import bz2
+import io
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import sys
+import zlib
+
+BLOCK_SIZE = 1 << 22  # bytes of uncompressed text per block
+COMPRESSION_LEVEL = 6
+
+# gzip header and trailer around a deflate stream
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Whether the bz2 module reads all the streams of a multi-stream file
+_MULTI_STREAM_BZ2 = sys.version_info[0] >= 3
+
+
+def _gzip_block(data):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _bz2_block(data):
+    return bz2.compress(data, COMPRESSION_LEVEL)
+
+
+COMPRESSORS = {
+    'gzip': _gzip_block,
+    'bz2': _bz2_block,
+}
+
+
+class BlockCompressingWriter(io.TextIOBase):
+    """A text file that compresses its content in blocks on a thread pool.
+
+    Args:
+        outfile (unicode): path of the compressed file
+        compression (unicode): 'gzip', or 'bz2' on Python 3 only since the
+            blocks form a multi-stream file
+        threads (int): number of compressing threads, None for one per core
+        block_size (int): bytes of uncompressed text per block
+        mode (unicode): 'w' to truncate the file or 'a' to append to it
+    """
+
+    def __init__(self, outfile, compression, threads=None, block_size=BLOCK_SIZE, mode='w'):
+        if compression not in COMPRESSORS:
+            raise ValueError('Unknown compression {}, expected one of {}'.format(
+                compression, sorted(COMPRESSORS)))
+        if compression == 'bz2' and not _MULTI_STREAM_BZ2:
+            raise ValueError(
+                'bz2 block compression writes multi-stream files, which Python 2 reads '
+                'only the first block of; use gzip instead')
+        self.compress = COMPRESSORS[compression]
+        self.block_size = block_size
+        self.outfile = io.open(outfile, mode + 'b')
+        self.pool = ThreadPool(threads)
+        # Bound the blocks held in memory while waiting for compression
+        self.max_pending = 2 * (threads or multiprocessing.cpu_count())
+        self.pending = []
+        self.blocks = []
+        self.buffered = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        data = text if isinstance(text, bytes) else text.encode('utf-8')
+        self.blocks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+        return len(text)
+
+    def _submit(self):
+        if self.buffered:
+            block = b''.join(self.blocks)
+            self.pending.append(self.pool.apply_async(self.compress, (block,)))
+            self.blocks = []
+            self.buffered = 0
+        while len(self.pending) > self.max_pending:
+            self.outfile.write(self.pending.pop(0).get())
+
+    def close(self):
+        """Compress the remaining text and close the file"""
+        if self.closed:
+            return
+        try:
+            self._submit()
+            for result in self.pending:
+                self.outfile.write(result.get())
+            self.pending = []
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.outfile.close()
+            super(BlockCompressingWriter, self).close()
+
+
+def to_csv(dataframe, outfile, compression=None, threads=None, **kwargs):
+    """Write a DataFrame to csv, optionally compressed in parallel.
+
+    Args:
+        dataframe (pandas.DataFrame): data to write
+        outfile (unicode): path to write to
+        compression (unicode): optional 'gzip', or 'bz2' on Python 3 only,
+            see `BlockCompressingWriter`
+        threads (int): number of compressing threads, None for one per core
+        kwargs: passed on to `DataFrame.to_csv`
+    """
+    if compression is None:
+        dataframe.to_csv(outfile, **kwargs)
+        return
+    mode = kwargs.pop('mode', 'w')
+    with BlockCompressingWriter(outfile, compression, threads, mode=mode) as writer:
+        dataframe.to_csv(writer, **kwargs)
@@ -0,0 +1,188 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Partitioned storage of tables keyed by tract.
+
+Tables are laid out as a `state=/county=/tract=` directory tree with one file
+per table in each partition.  A manifest at the root records the row count and
+byte size of every file, so readers can pick partitions without opening them.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+from collections import OrderedDict
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas
+
+from doppelganger import columnar, inputs
+
+MANIFEST_FILE = 'manifest.json'
+FILE_FORMATS = ('csv', 'parquet')
+
+
+def tract_locations(marginals):
+    """Map each tract of the marginals to its (state, county).
+
+    Args:
+        marginals (Marginals): marginals with STATEFP, COUNTYFP and TRACTCE codes
+
+    Returns:
+        dict: tract code to (state code, county code)
+    """
+    data = marginals.data
+    return {
+        str(tract): (str(state), str(county))
+        for state, county, tract in zip(data['STATEFP'], data['COUNTYFP'], data['TRACTCE'])
+    }
+
+
+def _partition_dir(tract, locations):
+    tract = str(tract)
+    parts = []
+    if locations is not None and tract in locations:
+        state, county = locations[tract]
+        parts = ['state=' + state, 'county=' + county]
+    return os.path.join(*(parts + ['tract=' + tract]))
+
+
+def _write_file(dataframe, path, file_format):
+    if file_format == 'parquet':
+        columnar.write_parquet(dataframe, path)
+    else:
+        dataframe.to_csv(path)
+    return {
+        'path': path,
+        'rows': len(dataframe),
+        'bytes': os.path.getsize(path),
+    }
+
+
+def write_partitioned(tables, output_dir, locations=None, file_format='csv', threads=None):
+    """Write tables partitioned by tract, one partition per directory.
+
+    Each partition's rows are sliced out of its table inside the job writing
+    them, so at most one slice per thread is held in memory besides the
+    tables.  The threads overlap file I/O and Parquet encoding, which
+    releases the GIL, but CSV formatting mostly holds it, so CSV partitions
+    gain little from more threads.
+
+    Args:
+        tables (OrderedDict(unicode, pandas.DataFrame)): tables to write by
+            name, each with a tract column
+        output_dir (unicode): root directory of the partitions
+        locations (dict): optional tract to (state, county), see
+            `tract_locations`.  Partitions of tracts without a location are
+            written directly under `output_dir`.
+        file_format (unicode): 'csv' or 'parquet'
+        threads (int): number of threads writing partitions concurrently,
+            None for one per core.  They mostly overlap I/O, see above.
+
+    Returns:
+        dict: the manifest, also written to `output_dir`
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError('Unknown file format {}, expected one of {}'.format(
+            file_format, FILE_FORMATS))
+
+    # Positions of each tract's rows in each table
+    table_rows = OrderedDict()
+    tracts = []
+    for name, dataframe in tables.items():
+        codes, uniques = pandas.factorize(dataframe[inputs.TRACT.name].astype(str).values)
+        order = np.argsort(codes, kind='mergesort')
+        ends = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+        table_rows[name] = dict(zip(uniques, np.split(order, ends[:-1]) if len(uniques) else []))
+        tracts.extend(tract for tract in uniques if tract not in tracts)
+
+    jobs = []
+    for tract in tracts:
+        partition_dir = _partition_dir(tract, locations)
+        if not os.path.isdir(os.path.join(output_dir, partition_dir)):
+            os.makedirs(os.path.join(output_dir, partition_dir))
+        for name, dataframe in tables.items():
+            rows = table_rows[name].get(tract, np.array([], dtype=int))
+            path = os.path.join(partition_dir, '{}.{}'.format(name, file_format))
+            jobs.append((tract, name, rows, path))
+
+    def write_job(job):
+        tract, name, rows, path = job
+        written = _write_file(
+            tables[name].iloc[rows], os.path.join(output_dir, path), file_format)
+        written['path'] = path
+        return written
+
+    pool = ThreadPool(threads)
+    try:
+        written = pool.map(write_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    partitions = OrderedDict()
+    for (tract, name, _, _), file_info in zip(jobs, written):
+        if tract not in partitions:
+            partition = OrderedDict([('tract', tract)])
+            if locations is not None and tract in locations:
+                partition['state'], partition['county'] = locations[tract]
+            partition['files'] = OrderedDict()
+            partitions[tract] = partition
+        partitions[tract]['files'][name] = file_info
+
+    manifest = OrderedDict([
+        ('format', file_format),
+        ('tables', list(tables.keys())),
+        ('partitions', list(partitions.values())),
+    ])
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as outfile:
+        json.dump(manifest, outfile, indent=2)
+    return manifest
+
+
+def read_manifest(input_dir):
+    """Load the manifest of a partitioned directory written by `write_partitioned`"""
+    with open(os.path.join(input_dir, MANIFEST_FILE)) as infile:
+        return json.load(infile)
+
+
+def read_partitioned(input_dir, name, tracts=None, states=None, counties=None):
+    """Read a table from a partitioned directory written by `write_partitioned`.
+
+    Only the files of the requested partitions are opened.
+
+    Args:
+        input_dir (unicode): root directory of the partitions
+        name (unicode): table to read
+        tracts (iterable): optional tracts to read, defaults to all
+        states (iterable): optional state codes to read, defaults to all
+        counties (iterable): optional county codes to read, defaults to all
+
+    Returns:
+        pandas.DataFrame: the rows of the requested partitions
+    """
+    manifest = read_manifest(input_dir)
+    filters = [
+        (key, set(str(value) for value in values))
+        for key, values in (('tract', tracts), ('state', states), ('county', counties))
+        if values is not None
+    ]
+    dataframes = []
+    for partition in manifest['partitions']:
+        if any(partition.get(key) not in values for key, values in filters):
+            continue
+        path = os.path.join(input_dir, partition['files'][name]['path'])
+        if manifest['format'] == 'parquet':
+            dataframes.append(columnar.read_parquet(path))
+        else:
+            dataframes.append(pandas.read_csv(
+                path, index_col=0, dtype={inputs.TRACT.name: str}))
+    if not dataframes:
+        return pandas.DataFrame()
+    if manifest['format'] == 'parquet':
+        # Partitions have different categories
+        return columnar._as_categorical(pandas.concat(dataframes))
+    return pandas.concat(dataframes)
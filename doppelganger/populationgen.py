@@ -4,108 +4,924 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
+from collections import OrderedDict, deque
+import multiprocessing
+import random
+
+import numpy as np
 import pandas
 
-from doppelganger import inputs
+from doppelganger import columnar, compression as compressed, inputs, partitioned
+from doppelganger.allocation import HouseholdAllocator, SerialNumberIndex
+
+# Bit widths of the parts of packed integer household ids
+TRACT_CODE_BITS = 20
+SERIAL_CODE_BITS = 20
+REPEAT_INDEX_BITS = 23
+
+# Generative models of the current worker process, see _init_generation_worker
+_worker_models = {}
+
+
+def pack_household_ids(tract_codes, serial_codes, repeat_ids):
+    """Pack household id parts into single int64 household ids.
+
+    Args:
+        tract_codes (numpy array): tract code of each household
+        serial_codes (numpy array): serial number code of each household
+        repeat_ids (numpy array): repeat index of each household
+
+    Returns:
+        numpy array: int64 household ids
+    """
+    for values, bits, name in ((tract_codes, TRACT_CODE_BITS, 'tract codes'),
+                               (serial_codes, SERIAL_CODE_BITS, 'serial number codes'),
+                               (repeat_ids, REPEAT_INDEX_BITS, 'repeat indexes')):
+        if len(values) and (np.min(values) < 0 or np.max(values) >= 1 << bits):
+            raise ValueError('Too many {} to pack into household ids'.format(name))
+    tract_shift = SERIAL_CODE_BITS + REPEAT_INDEX_BITS
+    household_ids = np.asarray(tract_codes, dtype=np.int64) << tract_shift
+    household_ids |= np.asarray(serial_codes, dtype=np.int64) << REPEAT_INDEX_BITS
+    household_ids |= np.asarray(repeat_ids, dtype=np.int64)
+    return household_ids
+
+
+def unpack_household_ids(household_ids):
+    """Split packed household ids into their parts.
+
+    Returns:
+        (numpy array, numpy array, numpy array): tract codes, serial number
+            codes and repeat indexes
+    """
+    household_ids = np.asarray(household_ids, dtype=np.int64)
+    return (
+        household_ids >> (SERIAL_CODE_BITS + REPEAT_INDEX_BITS),
+        (household_ids >> REPEAT_INDEX_BITS) & ((1 << SERIAL_CODE_BITS) - 1),
+        household_ids & ((1 << REPEAT_INDEX_BITS) - 1),
+    )
+
+
+def _row_index(values):
+    """Index the positions of each distinct value.
+
+    Returns:
+        (array, list(numpy array)): distinct values in order of first
+            appearance, and the positions holding each of them
+    """
+    codes, uniques = pandas.factorize(values)
+    order = np.argsort(codes, kind='mergesort')
+    ends = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+    return uniques, np.split(order, ends[:-1]) if len(uniques) else []
+
+
+def _combination_codes(columns, n_rows):
+    """Code each row by its distinct combination of values of the columns
+
+    Returns:
+        (numpy array, numpy array): code of each row, from 0, and the first
+            row of each code
+    """
+    codes = np.zeros(n_rows, dtype=np.int64)
+    for values in columns:
+        value_codes, uniques = pandas.factorize(values)
+        codes = codes * (len(uniques) + 1) + value_codes + 1
+        codes, _ = pandas.factorize(codes)
+    _, first_rows = np.unique(codes, return_index=True)
+    return codes, first_rows
+
+
+class _RecordingRow(dict):
+    """A row of data as a dict, recording the keys looked up in it"""
+
+    def __init__(self, values, accessed):
+        super(_RecordingRow, self).__init__(values)
+        self.accessed = accessed
+
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        return super(_RecordingRow, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed.add(key)
+        return super(_RecordingRow, self).get(key, default)
+
+
+def _discover_segments(data, segmenter, columns=()):
+    """Segment data while finding the columns of data a segmenter reads.
+
+    The segmenter is called on a row of each distinct combination of the
+    columns found so far, starting from `columns`, until no call reads a new
+    column.  Given the columns of an earlier call, that is a single pass.
+
+    Returns:
+        (list, numpy array, numpy array): the columns read, the code of each
+            row's combination of them and the segment of each code, or None
+            if the segmenter does more than look up keys
+    """
+    columns = list(columns)
+    while True:
+        codes, first_rows = _combination_codes(
+            [data[column].values for column in columns], len(data))
+        accessed = set()
+        distinct = np.empty(len(first_rows), dtype=object)
+        try:
+            distinct[:] = [
+                segmenter(_RecordingRow(zip(data.columns, data.iloc[row].values), accessed))
+                for row in first_rows
+            ]
+        except Exception:
+            return None
+        new_columns = [column for column in data.columns if column in accessed - set(columns)]
+        if not new_columns:
+            return columns, codes, distinct
+        columns.extend(new_columns)
+
+
+def _init_generation_worker(person_model, household_model, id_codes, preprocessor,
+                            joined=False):
+    _worker_models['person'] = person_model
+    _worker_models['household'] = household_model
+    _worker_models['id_codes'] = id_codes
+    _worker_models['preprocessor'] = preprocessor
+    _worker_models['joined'] = joined
+    _worker_models['segmenter_columns'] = {}
+    # Forked workers inherit the parent's random state, reseed so they draw
+    # different samples
+    np.random.seed()
+    random.seed()
+
+
+def _generate_chunk_in_worker(chunk_allocator):
+    return Population._generate_population(
+        chunk_allocator, _worker_models['person'], _worker_models['household'],
+        _worker_models['id_codes'], _worker_models['preprocessor'], _worker_models['joined'],
+        _worker_models['segmenter_columns'])
+
+
+def _apply_in_order(pool, func, iterable, max_pending):
+    """Yield func of each item, computed on pool, in the order of iterable.
+
+    At most `max_pending` items are submitted ahead of the one being waited
+    on, so neither their inputs nor their results pile up when the consumer
+    is slower than the pool.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
 class Population(object):
-    def __init__(self, generated_people, generated_households):
+    def __init__(self, generated_people, generated_households, generated_joined=None):
         self.generated_people = generated_people
         self.generated_households = generated_households
+        # Optional person-level table with household attributes attached
+        self.generated_joined = generated_joined
 
     @staticmethod
-    def from_csvs(persons_infile, households_infile):
+    def from_csvs(persons_infile, households_infile, compression='infer'):
         """Load generated population from file.
 
         Args:
             persons_infile (basestring or file like): persons csv file
             households_infile (basestring or file like): households csv file
+            compression (unicode): 'gzip', 'bz2', None or 'infer' from the
+                file extension
+
+        Returns:
+            Population: generated population
+
+        """
+        generated_people = pandas.read_csv(persons_infile, compression=compression)
+        generated_households = pandas.read_csv(households_infile, compression=compression)
+        return Population(generated_people, generated_households)
+
+    @staticmethod
+    def from_parquet(persons_infile, households_infile, person_columns=None,
+                     household_columns=None, tracts=None):
+        """Load generated population from Parquet files written by `write_parquet`.
+
+        Args:
+            persons_infile (unicode): persons Parquet file
+            households_infile (unicode): households Parquet file
+            person_columns (iterable(unicode)): optional person columns to load
+            household_columns (iterable(unicode)): optional household columns to load
+            tracts (iterable): optional tracts to load, defaults to all
 
         Returns:
             Population: generated population
 
         """
-        generated_people = pandas.read_csv(persons_infile)
-        generated_households = pandas.read_csv(households_infile)
+        generated_people = columnar.read_parquet(persons_infile, person_columns, tracts)
+        generated_households = columnar.read_parquet(
+            households_infile, household_columns, tracts)
+        return Population(generated_people, generated_households)
+
+    @staticmethod
+    def from_partitioned(input_dir, tracts=None, states=None, counties=None):
+        """Load generated population written by `write_partitioned`.
+
+        Only the partitions of the requested tracts, states and counties are
+        read, as found in the manifest.
+
+        Args:
+            input_dir (unicode): root directory of the partitions
+            tracts (iterable): optional tracts to load, defaults to all
+            states (iterable): optional state codes to load, defaults to all
+            counties (iterable): optional county codes to load, defaults to all
+
+        Returns:
+            Population: generated population
+        """
+        generated_people = partitioned.read_partitioned(
+            input_dir, 'persons', tracts, states, counties)
+        generated_households = partitioned.read_partitioned(
+            input_dir, 'households', tracts, states, counties)
         return Population(generated_people, generated_households)
 
     @staticmethod
-    def _extract_person_evidence(allocated_rows, fields, segmenter, household_allocator):
-        """Creates a (python) generator for bayesian network evidence for persons that yields
-         (serial number, evidence, segment, tract, count)
+    def _person_counts(allocated_rows, household_allocator):
+        """Join the household repeat counts onto persons, through the
+        allocator's serial number index.
+
+        Returns:
+            (numpy array, numpy array, numpy array, numpy array): position of
+                the person in `allocated_rows`, tract, repeat count and position
+                of the household in the allocated households for each (person, tract)
+        """
+        # Persons in input order, each repeated in the allocator's tract order
+        person_rows, household_rows, counts = household_allocator.get_counts_bulk(
+            allocated_rows[inputs.SERIAL_NUMBER.name].values)
+        return person_rows, counts.tract, counts.count, household_rows
+
+    @staticmethod
+    def _household_counts(allocated_rows, _):
+        """Households store their repeat information directly.
+
+        Returns:
+            (numpy array, numpy array, numpy array, numpy array): position of
+                the household in `allocated_rows`, tract, repeat count and
+                position of the household again
+        """
+        rows = np.arange(len(allocated_rows))
+        return (
+            rows,
+            allocated_rows[inputs.TRACT.name].values,
+            allocated_rows[inputs.COUNT.name].values,
+            rows,
+        )
+
+    @staticmethod
+    def _segments(data, segmenter, segmenter_columns=None):
+        """Segment of each row of data.
+
+        The segmenter is called once per distinct combination of the columns
+        it reads.  Those are its `columns` attribute if it has one, or else
+        found by recording the keys it looks up.  Segmenters which need more
+        than key lookups fall back to one call per row.
+
+        Args:
+            data (pandas.DataFrame): rows to segment
+            segmenter (callable): segment of a row
+            segmenter_columns (dict): optional columns found in earlier
+                calls, by segmenter and data columns, which are updated
+
+        Returns:
+            numpy array: segment of each row
         """
-        for _, row in allocated_rows.iterrows():
-            serialno = row[inputs.SERIAL_NUMBER.name]
-            evidence = tuple((field, row[field]) for field in fields)
-            segment = segmenter(row)
-            # Draw repeat information for persons from from the allocator
-            count_info = household_allocator.get_counts(serialno)
-            for tract, count in count_info:
-                yield serialno, evidence, segment, tract, count
+        segments = np.empty(len(data), dtype=object)
+        if not len(data):
+            return segments
+        columns = getattr(segmenter, 'columns', None)
+        if not isinstance(columns, (list, tuple)):
+            if segmenter_columns is None:
+                segmenter_columns = {}
+            key = (segmenter, tuple(data.columns))
+            discovered = _discover_segments(data, segmenter, segmenter_columns.get(key, ()))
+            if discovered is None:
+                segments[:] = [segmenter(row) for _, row in data.iterrows()]
+                return segments
+            segmenter_columns[key], codes, distinct = discovered
+            segments[:] = distinct[codes]
+            return segments
+        codes, first_rows = _combination_codes(
+            [data[column].values for column in columns], len(data))
+        distinct = np.empty(len(first_rows), dtype=object)
+        distinct[:] = [segmenter(row) for _, row in data.iloc[first_rows].iterrows()]
+        segments[:] = distinct[codes]
+        return segments
 
     @staticmethod
-    def _extract_household_evidence(allocated_rows, fields, segmenter, _):
-        """Creates a (python) generator for bayesian network evidence for households that yields
-         (serial number, evidence, segment, tract, count)
+    def _evidence_groups(data, segmenter, fields, segmenter_columns=None):
+        """Group the rows of data by segment and evidence.
+
+        Returns:
+            (numpy array, list): group code of each row and the (segment,
+                evidence) pair of each group, indexed by code
         """
-        for _, row in allocated_rows.iterrows():
-            serialno = row[inputs.SERIAL_NUMBER.name]
-            evidence = tuple((field, row[field]) for field in fields)
-            segment = segmenter(row)
-            # Households store their repeat information directly
-            yield serialno, evidence, segment, row[inputs.TRACT.name], row['count']
+        segments = Population._segments(data, segmenter, segmenter_columns)
+        key_codes, first_rows = _combination_codes(
+            [segments] + [data[field].values for field in fields], len(data))
+        keys = [
+            (segments[row], tuple((field, data[field].values[row]) for field in fields))
+            for row in first_rows
+        ]
+        return key_codes, keys
 
     @staticmethod
-    def _generate_from_model(household_allocator, data, model, fields, evidence_fn):
+    def _generate_from_model(household_allocator, data, model, fields, counts_fn, id_codes,
+                             preprocessor=None, segmenter_columns=None):
         """Generate the given fields of the given data generated by the
         given model
+
+        Household ids are packed from the codes of the tract and serial number
+        in `id_codes`, a pair of pandas.Index, and the repeat index.  Tracts,
+        serial numbers and generated fields are categorical, with the
+        preprocessor's possible values as categories when one is given.
+
+        Rows of `data` sharing a (segment, evidence) pair are grouped before
+        expansion, each group is sampled with a single call for the total of
+        its counts and the samples are scattered back to the repeated rows.
+
+        Returns:
+            (pandas.DataFrame, numpy array): the generated rows, and the
+                position of each row's household among the generated households
+        """
+        rows, tracts, counts, household_rows = counts_fn(data, household_allocator)
+        counts = counts.astype(int)
+        n_generated = counts.sum()
+
+        # Expand each (row, tract) allocation into its repeats
+        expanded = np.repeat(np.arange(len(rows)), counts)
+        repeat_ids = np.arange(n_generated) - np.repeat(np.cumsum(counts) - counts, counts)
+        source_rows = rows[expanded]
+
+        # Households are generated in allocation order, each repeated count times
+        household_counts = \
+            household_allocator.allocated_households[inputs.COUNT.name].values.astype(int)
+        household_starts = np.cumsum(household_counts) - household_counts
+        household_positions = household_starts[household_rows[expanded]] + repeat_ids
+
+        key_codes, keys = Population._evidence_groups(
+            data, model.segmenter, fields, segmenter_columns)
+        group_counts = np.bincount(
+            key_codes[rows], weights=counts, minlength=len(keys)).astype(int)
+
+        # Sample each group once, in the order of the sorted expanded rows
+        sampled = [[] for _ in model.fields]
+        for (segment, evidence), count in zip(keys, group_counts):
+            if count:
+                generated_rows = model.generate(segment, evidence, count=count)
+                for column, values in zip(sampled, zip(*generated_rows)):
+                    column.extend(values)
+
+        order = np.argsort(key_codes[source_rows], kind='mergesort')
+        generated_columns = []
+        for values in sampled:
+            column = np.empty(n_generated, dtype=object)
+            column[order] = values
+            generated_columns.append(column)
+
+        tract_index, serialno_index = id_codes
+        tract_codes = tract_index.get_indexer(tracts[expanded])
+        serialno_codes = serialno_index.get_indexer(
+            data[inputs.SERIAL_NUMBER.name].values[source_rows])
+        household_ids = pack_household_ids(tract_codes, serialno_codes, repeat_ids)
+        repeat_dtype = np.min_scalar_type(repeat_ids.max() if n_generated else 0)
+
+        columns = [
+            (inputs.HOUSEHOLD_ID.name, household_ids),
+            (inputs.TRACT.name, pandas.Categorical.from_codes(tract_codes, tract_index)),
+            (inputs.SERIAL_NUMBER.name,
+             pandas.Categorical.from_codes(serialno_codes, serialno_index)),
+            (inputs.REPEAT_INDEX.name, repeat_ids.astype(repeat_dtype)),
+        ] + [
+            (field, Population._categorical(values, field, preprocessor))
+            for field, values in zip(model.fields, generated_columns)
+        ]
+        return pandas.DataFrame.from_dict(OrderedDict(columns)), household_positions
+
+    @staticmethod
+    def _categorical(values, field, preprocessor):
+        """Convert generated values of a field to a Categorical.
+
+        The categories are the field's possible values according to the
+        preprocessor, followed by any other generated values.
+        """
+        possible_values = None
+        if preprocessor is not None:
+            try:
+                possible_values = preprocessor.get_possible_values(field)
+            except KeyError:
+                pass
+        if possible_values is None:
+            return pandas.Categorical(values)
+        if isinstance(possible_values, (set, frozenset)):
+            possible_values = sorted(possible_values, key=str)
+        categories = list(possible_values)
+        known = set(categories)
+        categories += [
+            value for value in pandas.unique(values)
+            if value not in known and not pandas.isnull(value)
+        ]
+        return pandas.Categorical(values, categories=categories)
+
+    @staticmethod
+    def _join(persons, households, household_positions):
+        """Attach household attributes to persons by position, without a merge
+
+        Args:
+            persons (pandas.DataFrame): generated persons
+            households (pandas.DataFrame): generated households
+            household_positions (numpy array): position of each person's
+                household in `households`
+
+        Returns:
+            pandas.DataFrame: persons with the household columns they lack
         """
-        results = []
-        for serialno, evidence, segment, tract, count in evidence_fn(
-                data,
-                fields,
-                model.segmenter,
-                household_allocator
-        ):
-            generated_rows = model.generate(segment, evidence, count=count)
-            for repeat_id, row in enumerate(generated_rows):
-                household_id = '{}-{}-{}'.format(tract, serialno, repeat_id)
-                results.append((household_id, tract, serialno, repeat_id) + row)
-
-        column_names = [inputs.HOUSEHOLD_ID.name, inputs.TRACT.name, inputs.SERIAL_NUMBER.name,
-                        inputs.REPEAT_INDEX.name] + list(model.fields)
-        results_dataframe = pandas.DataFrame(results, columns=column_names)
-        return results_dataframe
-
-    @staticmethod
-    def generate(household_allocator, person_model, household_model):
+        joined = persons.copy(deep=False)
+        for name in households.columns:
+            if name not in joined:
+                joined[name] = households[name].take(household_positions).values
+        return joined
+
+    @staticmethod
+    def _generate_population(household_allocator, person_model, household_model, id_codes,
+                             preprocessor=None, joined=False, segmenter_columns=None):
+        persons, household_positions = Population._generate_from_model(
+            household_allocator, household_allocator.allocated_persons,
+            person_model, [inputs.AGE.name, inputs.SEX.name], Population._person_counts,
+            id_codes, preprocessor, segmenter_columns
+        )
+        households, _ = Population._generate_from_model(
+            household_allocator, household_allocator.allocated_households,
+            household_model, [inputs.NUM_PEOPLE.name], Population._household_counts,
+            id_codes, preprocessor, segmenter_columns
+        )
+        generated_joined = None
+        if joined:
+            generated_joined = Population._join(persons, households, household_positions)
+        return Population(persons, households, generated_joined)
+
+    @staticmethod
+    def generate(household_allocator, person_model, household_model, processes=1,
+                 preprocessor=None, joined=False, sample_fraction=1.):
         """Create all the persons and households for this population
 
         Args:
             household_allocator (HouseholdAllocator): allocated households
             person_model (BayesianNetworkNodel): optional generative model
             household_model (BayesianNetworkNodel): optional generative model
+            processes (int): number of worker processes generating tracts in
+                parallel, None for one per core.  Results are concatenated in
+                tract order.
+            preprocessor (Preprocessor): optional preprocessor whose possible
+                values become the categories of the generated fields
+            joined (bool): also create `generated_joined`, the persons with
+                their household's attributes attached
+            sample_fraction (float): optional fraction of the population to
+                generate, see `HouseholdAllocator.sample`
 
-        Returns: Population from the given model
+        Returns: Population from the given model.  Household ids are packed
+            integers, see `household_id_strings` for their string form.
         """
+        if sample_fraction != 1:
+            household_allocator = household_allocator.sample(sample_fraction)
+        if processes == 1:
+            return Population._generate_population(
+                household_allocator, person_model, household_model,
+                Population._id_codes(household_allocator), preprocessor, joined
+            )
+        chunks = list(Population.generate_chunks(
+            household_allocator, person_model, household_model, processes=processes,
+            preprocessor=preprocessor, joined=joined))
+        if not chunks:
+            return Population._generate_population(
+                HouseholdAllocator(household_allocator.allocated_households.iloc[:0],
+                                   household_allocator.allocated_persons.iloc[:0]),
+                person_model, household_model, Population._id_codes(household_allocator),
+                preprocessor, joined
+            )
+        generated_joined = None
+        if joined:
+            generated_joined = Population._concat([chunk.generated_joined for chunk in chunks])
+        return Population(
+            Population._concat([chunk.generated_people for chunk in chunks]),
+            Population._concat([chunk.generated_households for chunk in chunks]),
+            generated_joined,
+        )
 
-        persons = Population._generate_from_model(
-            household_allocator, household_allocator.allocated_persons,
-            person_model, [inputs.AGE.name, inputs.SEX.name], Population._extract_person_evidence
+    @staticmethod
+    def _concat(dataframes):
+        """Concatenate generated chunks, keeping categorical columns categorical"""
+        result = pandas.concat(dataframes)
+        for name, dtype in dataframes[0].dtypes.items():
+            if dtype.name == 'category' and result[name].dtype.name != 'category':
+                # Chunks had different categories
+                result[name] = result[name].astype('category')
+        return result
+
+    @staticmethod
+    def _id_codes(household_allocator):
+        """Index tracts and serial numbers by the integer codes used in household ids
+
+        Codes follow the sorted values, so packed ids do not depend on the
+        order of the allocated households.  They are only unique within one
+        allocation though: populations of several allocations, e.g. of the
+        PUMAs of a state, must be combined with string ids.
+
+        Returns:
+            (pandas.Index, pandas.Index): sorted tracts and serial numbers of
+                the allocated households
+        """
+        households = household_allocator.allocated_households
+        return tuple(
+            pandas.Index(np.asarray(pandas.unique(households[column].values))).sort_values()
+            for column in (inputs.TRACT.name, inputs.SERIAL_NUMBER.name)
         )
-        households = Population._generate_from_model(
-            household_allocator, household_allocator.allocated_households,
-            household_model, [inputs.NUM_PEOPLE.name], Population._extract_household_evidence
+
+    @staticmethod
+    def _tract_chunks(allocated_households, chunk_size=None):
+        """Split allocated households into chunks of whole tracts.
+
+        Args:
+            allocated_households (pandas.DataFrame): households with tract and count
+            chunk_size (int): approximate number of households to generate per
+                chunk.  Tracts are never split, so one tract per chunk if None.
+
+        Yields:
+            pandas.DataFrame: the allocated households of a chunk of tracts
+        """
+        _, tract_rows = _row_index(allocated_households[inputs.TRACT.name].values)
+        counts = allocated_households[inputs.COUNT.name].values
+
+        chunk_rows = []
+        chunk_households = 0
+        for i, rows in enumerate(tract_rows):
+            chunk_rows.append(rows)
+            chunk_households += counts[rows].sum()
+            if chunk_size is None or chunk_households >= chunk_size or i == len(tract_rows) - 1:
+                yield allocated_households.iloc[np.concatenate(chunk_rows)]
+                chunk_rows = []
+                chunk_households = 0
+
+    @staticmethod
+    def _person_index(household_allocator):
+        """Index the allocated persons by serial number, see `_chunk_allocator`"""
+        return SerialNumberIndex(
+            household_allocator.allocated_persons[inputs.SERIAL_NUMBER.name].values)
+
+    @staticmethod
+    def _chunk_allocator(household_allocator, households, person_index):
+        """The allocation of some of the allocated households and their persons
+
+        Args:
+            household_allocator (HouseholdAllocator): allocated households
+            households (pandas.DataFrame): some of the allocated households
+            person_index (SerialNumberIndex): index of the allocated persons
+
+        Returns:
+            HouseholdAllocator: the households with a nonzero count and their
+                persons, in input order
+        """
+        households = households[households[inputs.COUNT.name] > 0]
+        _, person_rows = person_index.lookup_many(
+            np.unique(households[inputs.SERIAL_NUMBER.name].values))
+        return HouseholdAllocator(
+            households, household_allocator.allocated_persons.iloc[np.sort(person_rows)])
+
+    @staticmethod
+    def _chunk_inputs(household_allocator, chunk_size):
+        """Yields a HouseholdAllocator of the households and persons of each chunk"""
+        person_index = Population._person_index(household_allocator)
+        for households in Population._tract_chunks(
+                household_allocator.allocated_households, chunk_size):
+            yield Population._chunk_allocator(household_allocator, households, person_index)
+
+    @staticmethod
+    def iter_tracts(household_allocator, person_model, household_model, preprocessor=None):
+        """Create the population lazily, one tract at a time.
+
+        Args:
+            household_allocator (HouseholdAllocator): allocated households
+            person_model (BayesianNetworkNodel): optional generative model
+            household_model (BayesianNetworkNodel): optional generative model
+            preprocessor (Preprocessor): optional preprocessor whose possible
+                values become the categories of the generated fields
+
+        Returns:
+            LazyPopulation: iterable of (tract, Population) that generates
+                each tract on demand
+        """
+        return LazyPopulation(household_allocator, person_model, household_model, preprocessor)
+
+    @staticmethod
+    def generate_chunks(household_allocator, person_model, household_model, chunk_size=None,
+                        processes=1, preprocessor=None, joined=False):
+        """Create the population in chunks of whole tracts.
+
+        Row indexes continue across chunks, so the concatenated chunks form
+        the whole population.  Chunks can be generated in parallel by a pool
+        of worker processes; they are still yielded in tract order.  At most
+        two chunks per process are in flight at once.
+
+        Args:
+            household_allocator (HouseholdAllocator): allocated households
+            person_model (BayesianNetworkNodel): optional generative model
+            household_model (BayesianNetworkNodel): optional generative model
+            chunk_size (int): approximate number of households to generate per
+                chunk, defaults to one tract per chunk
+            processes (int): number of worker processes, None for one per core
+            preprocessor (Preprocessor): optional preprocessor whose possible
+                values become the categories of the generated fields
+            joined (bool): also create the joined person-level table of each chunk
+
+        Yields:
+            Population: the persons and households of a chunk of tracts
+        """
+        chunk_inputs = Population._chunk_inputs(household_allocator, chunk_size)
+        id_codes = Population._id_codes(household_allocator)
+        pool = None
+        if processes == 1:
+            # Columns read by the segmenters, found on the first chunk
+            segmenter_columns = {}
+            chunks = (
+                Population._generate_population(chunk_allocator, person_model, household_model,
+                                                id_codes, preprocessor, joined, segmenter_columns)
+                for chunk_allocator in chunk_inputs
+            )
+        else:
+            pool = multiprocessing.Pool(
+                processes, _init_generation_worker,
+                (person_model, household_model, id_codes, preprocessor, joined))
+            chunks = _apply_in_order(
+                pool, _generate_chunk_in_worker, chunk_inputs,
+                2 * (processes or multiprocessing.cpu_count()))
+
+        try:
+            person_offset = household_offset = 0
+            for chunk in chunks:
+                chunk.generated_people.index += person_offset
+                if chunk.generated_joined is not None:
+                    chunk.generated_joined.index += person_offset
+                chunk.generated_households.index += household_offset
+                person_offset += len(chunk.generated_people)
+                household_offset += len(chunk.generated_households)
+                yield chunk
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    @staticmethod
+    def generate_to_csvs(household_allocator, person_model, household_model, persons_outfile,
+                         households_outfile, chunk_size=None, processes=1, preprocessor=None,
+                         compression=None):
+        """Create the population chunk by chunk, appending each chunk to the given files.
+
+        Peak memory is bounded by the chunk size times the number of chunks in
+        flight (two per process) rather than by the population size.
+
+        Args:
+            household_allocator (HouseholdAllocator): allocated households
+            person_model (BayesianNetworkNodel): optional generative model
+            household_model (BayesianNetworkNodel): optional generative model
+            persons_outfile (unicode): path to write persons to
+            households_outfile (unicode): path to write households to
+            chunk_size (int): approximate number of households to generate per
+                chunk, defaults to one tract per chunk
+            processes (int): number of worker processes, None for one per core
+            preprocessor (Preprocessor): optional preprocessor whose possible
+                values become the categories of the generated fields
+            compression (unicode): optional 'gzip' or 'bz2' (Python 3 only).
+                Blocks are compressed on a thread pool while the next ones
+                are generated.
+        """
+        chunks = Population.generate_chunks(
+            household_allocator, person_model, household_model, chunk_size, processes,
+            preprocessor)
+        if compression is None:
+            first_chunk = True
+            for chunk in chunks:
+                mode = 'w' if first_chunk else 'a'
+                Population._with_string_ids(chunk.generated_people).to_csv(
+                    persons_outfile, mode=mode, header=first_chunk)
+                Population._with_string_ids(chunk.generated_households).to_csv(
+                    households_outfile, mode=mode, header=first_chunk)
+                first_chunk = False
+            return
+
+        with compressed.BlockCompressingWriter(persons_outfile, compression) as persons_writer, \
+                compressed.BlockCompressingWriter(
+                    households_outfile, compression) as households_writer:
+            first_chunk = True
+            for chunk in chunks:
+                Population._with_string_ids(chunk.generated_people).to_csv(
+                    persons_writer, header=first_chunk)
+                Population._with_string_ids(chunk.generated_households).to_csv(
+                    households_writer, header=first_chunk)
+                first_chunk = False
+
+    @staticmethod
+    def generate_to_arrow_streams(household_allocator, person_model, household_model,
+                                  persons_sink, households_sink, chunk_size=None, processes=1,
+                                  preprocessor=None, string_ids=True):
+        """Create the population chunk by chunk, streaming each chunk in Arrow IPC format.
+
+        Every chunk is sent as one record batch as soon as it is generated, so
+        a consumer reading the other end of a pipe or socket can start before
+        the whole population exists.
+
+        Args:
+            household_allocator (HouseholdAllocator): allocated households
+            person_model (BayesianNetworkNodel): optional generative model
+            household_model (BayesianNetworkNodel): optional generative model
+            persons_sink: path, file descriptor, socket or binary file-like
+                object to stream persons to
+            households_sink: path, file descriptor, socket or binary file-like
+                object to stream households to
+            chunk_size (int): approximate number of households to generate per
+                chunk, defaults to one tract per chunk
+            processes (int): number of worker processes, None for one per core
+            preprocessor (Preprocessor): optional preprocessor whose possible
+                values become the categories of the generated fields
+            string_ids (bool): stream household ids as strings rather than
+                packed integers, which are only unique within one allocation
+        """
+        with columnar.ArrowStreamWriter(persons_sink) as persons_writer, \
+                columnar.ArrowStreamWriter(households_sink) as households_writer:
+            for chunk in Population.generate_chunks(
+                    household_allocator, person_model, household_model, chunk_size, processes,
+                    preprocessor):
+                persons = chunk.generated_people
+                households = chunk.generated_households
+                if string_ids:
+                    persons = Population._with_string_ids(persons)
+                    households = Population._with_string_ids(households)
+                persons_writer.write(persons)
+                households_writer.write(households)
+
+    @staticmethod
+    def household_id_strings(dataframe):
+        """Render the household ids of generated rows as 'tract-serialno-repeat' strings
+
+        Args:
+            dataframe (pandas.DataFrame): generated persons or households
+
+        Returns:
+            pandas.Series: string household ids
+        """
+        return (
+            dataframe[inputs.TRACT.name].astype(str) + '-' +
+            dataframe[inputs.SERIAL_NUMBER.name].astype(str) + '-' +
+            dataframe[inputs.REPEAT_INDEX.name].astype(str)
         )
-        return Population(persons, households)
 
-    def write(self, persons_outfile, households_outfile):
+    @staticmethod
+    def _with_string_ids(dataframe):
+        """Return dataframe with packed integer household ids rendered as strings"""
+        if inputs.HOUSEHOLD_ID.name not in dataframe or \
+                dataframe[inputs.HOUSEHOLD_ID.name].dtype.kind != 'i':
+            return dataframe
+        rendered = dataframe.copy(deep=False)
+        rendered[inputs.HOUSEHOLD_ID.name] = Population.household_id_strings(dataframe)
+        return rendered
+
+    def write(self, persons_outfile, households_outfile, string_ids=True, compression=None):
         """Write population to the given file
 
         Args:
-            outfile (unicode): path to write to
+            persons_outfile (unicode): path to write persons to
+            households_outfile (unicode): path to write households to
+            string_ids (bool): write household ids as strings rather than
+                packed integers
+            compression (unicode): optional 'gzip' or 'bz2' (Python 3 only),
+                compressed in blocks on a thread pool
+
+        """
+        persons = self.generated_people
+        households = self.generated_households
+        if string_ids:
+            persons = Population._with_string_ids(persons)
+            households = Population._with_string_ids(households)
+        compressed.to_csv(persons, persons_outfile, compression)
+        compressed.to_csv(households, households_outfile, compression)
+
+    def write_joined(self, outfile, string_ids=True, compression=None):
+        """Write the joined person-level table to the given file
+
+        Args:
+            outfile (unicode): path to write the joined persons to
+            string_ids (bool): write household ids as strings rather than
+                packed integers
+            compression (unicode): optional 'gzip' or 'bz2' (Python 3 only),
+                compressed in blocks on a thread pool
+
+        """
+        if self.generated_joined is None:
+            raise ValueError('Population was generated without joined=True')
+        joined = self.generated_joined
+        if string_ids:
+            joined = Population._with_string_ids(joined)
+        compressed.to_csv(joined, outfile, compression)
+
+    def write_parquet(self, persons_outfile, households_outfile, string_ids=True):
+        """Write population to Parquet files, with one row group per tract
+
+        Args:
+            persons_outfile (unicode): path to write persons to
+            households_outfile (unicode): path to write households to
+            string_ids (bool): write household ids as strings rather than
+                packed integers, which are only unique within one allocation
+
+        """
+        if string_ids:
+            columnar.write_parquet(Population._with_string_ids(self.generated_people),
+                                   persons_outfile)
+            columnar.write_parquet(Population._with_string_ids(self.generated_households),
+                                   households_outfile)
+        else:
+            columnar.write_parquet(self.generated_people, persons_outfile)
+            columnar.write_parquet(self.generated_households, households_outfile)
+
+    def write_partitioned(self, output_dir, marginals=None, file_format='csv', threads=None,
+                          string_ids=True):
+        """Write population as a `state=/county=/tract=` directory tree
+
+        Each partition holds a persons and a households file, written on a
+        thread pool, see `partitioned.write_partitioned`.  A manifest.json at
+        the root records the row count and byte size of every file.
+
+        Args:
+            output_dir (unicode): root directory of the partitions
+            marginals (Marginals): optional marginals locating tracts in their
+                state and county.  Without them partitions are `tract=` only.
+            file_format (unicode): 'csv' or 'parquet'
+            threads (int): number of threads writing partitions concurrently,
+                None for one per core.  They mostly overlap I/O.
+            string_ids (bool): write household ids as strings rather than
+                packed integers
+
+        Returns:
+            dict: the manifest
+        """
+        persons = self.generated_people
+        households = self.generated_households
+        if string_ids:
+            persons = Population._with_string_ids(persons)
+            households = Population._with_string_ids(households)
+        locations = partitioned.tract_locations(marginals) if marginals is not None else None
+        return partitioned.write_partitioned(
+            OrderedDict([('persons', persons), ('households', households)]),
+            output_dir, locations, file_format, threads)
+
+
+class LazyPopulation(object):
+    """A population generated tract by tract, on demand.
+
+    Allocated households are indexed by tract and allocated persons by serial
+    number up front, so generating one tract only touches that tract's rows.
+    The columns read by the models' segmenters are found on the first tract
+    generated and reused.  Iterating yields (tract, Population) pairs in
+    allocation order.
+    """
+
+    def __init__(self, household_allocator, person_model, household_model, preprocessor=None):
+        self.household_allocator = household_allocator
+        self.person_model = person_model
+        self.household_model = household_model
+        self.preprocessor = preprocessor
+        self.id_codes = Population._id_codes(household_allocator)
+
+        tracts, tract_rows = _row_index(
+            household_allocator.allocated_households[inputs.TRACT.name].values)
+        self.tracts = list(tracts)
+        self.tract_to_rows = dict(zip(self.tracts, tract_rows))
+        self.person_index = Population._person_index(household_allocator)
+        self.segmenter_columns = {}
+
+    def __len__(self):
+        return len(self.tracts)
+
+    def __iter__(self):
+        for tract in self.tracts:
+            yield tract, self.generate_tract(tract)
+
+    def generate_tract(self, tract):
+        """Create the persons and households of a single tract
+
+        Args:
+            tract: the tract, as found in the allocated households
 
+        Returns:
+            Population: the tract's persons and households
         """
-        self.generated_people.to_csv(persons_outfile)
-        self.generated_households.to_csv(households_outfile)
+        households = self.household_allocator.allocated_households.iloc[
+            self.tract_to_rows[tract]]
+        return Population._generate_population(
+            Population._chunk_allocator(self.household_allocator, households, self.person_index),
+            self.person_model, self.household_model, self.id_codes, self.preprocessor,
+            segmenter_columns=self.segmenter_columns)
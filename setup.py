@@ -29,6 +29,9 @@ setup(
             'pytest-cov',
             'jupyter',
         ],
+        'parquet': [
+            'pyarrow>=0.15.0',
+        ],
     },
 
 )
@@ -5,10 +5,22 @@ from __future__ import (
 )
 
 from mock import MagicMock, patch
+import os
+import shutil
+import json
+import tempfile
 import unittest
+import numpy
 import pandas
 
-from doppelganger import (HouseholdAllocator, CleanedData, Marginals)
+from doppelganger import (HouseholdAllocator, CleanedData, Marginals, listbalancer)
+from doppelganger.allocation import TractMultipliers
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 
 class TestAllocation(unittest.TestCase):
@@ -111,13 +123,198 @@ class TestAllocation(unittest.TestCase):
         self.assertEqual(set(allocator.allocated_households.columns.tolist()),
                          set(expected_columns))
 
+    def test_allocate_households_reuses_cvx_problem(self):
+        households, persons = HouseholdAllocator._format_data(
+            self._mock_household_data(), self._mock_person_data())
+        marginals = Marginals(self._mock_tract_data())
+
+        listbalancer._cvx_problems.clear()
+        HouseholdAllocator._allocate_households(households, persons, marginals)
+        self.assertEqual(len(listbalancer._cvx_problems), 1)
+        problem = list(listbalancer._cvx_problems.values())[0]
+        HouseholdAllocator._allocate_households(households, persons, marginals)
+        self.assertEqual(list(listbalancer._cvx_problems.values()), [problem])
+
+    def test_from_cleaned_data_decomposed(self):
+        households_data = CleanedData(self._mock_household_data())
+        persons_data = CleanedData(self._mock_person_data())
+        marginals = Marginals(self._mock_tract_data())
+        allocator = HouseholdAllocator.from_cleaned_data(
+            marginals, households_data, persons_data, balancer='decomposed')
+        self.assertEqual(allocator.allocated_households.shape, (114, 17))
+        self.assertTrue((allocator.allocated_households['count'] >= 0).all())
+        multipliers = allocator.multipliers
+        self.assertEqual(multipliers.lambdas.shape, (len(multipliers.tracts),
+                                                     len(multipliers.controls)))
+
+        warm_allocator = HouseholdAllocator.from_cleaned_data(
+            marginals, households_data, persons_data, balancer='decomposed',
+            multipliers=multipliers)
+        numpy.testing.assert_allclose(
+            warm_allocator.multipliers.lambdas, multipliers.lambdas, atol=1e-3)
+
+        with self.assertRaises(ValueError):
+            HouseholdAllocator.from_cleaned_data(
+                marginals, households_data, persons_data, balancer='unknown')
+
+    def test_from_cleaned_data_trs(self):
+        households_data = CleanedData(self._mock_household_data())
+        persons_data = CleanedData(self._mock_person_data())
+        marginals = Marginals(self._mock_tract_data())
+        allocator = HouseholdAllocator.from_cleaned_data(
+            marginals, households_data, persons_data, balancer='ipf', discretizer='trs')
+        self.assertEqual(allocator.allocated_households.shape, (114, 17))
+        self.assertTrue((allocator.allocated_households['count'] >= 0).all())
+
+        with self.assertRaises(ValueError):
+            HouseholdAllocator.from_cleaned_data(
+                marginals, households_data, persons_data, discretizer='unknown')
+
+    def test_from_cleaned_data_warm_start(self):
+        households_data = CleanedData(self._mock_household_data())
+        persons_data = CleanedData(self._mock_person_data())
+        marginals = Marginals(self._mock_tract_data())
+        allocator = HouseholdAllocator.from_cleaned_data(
+            marginals, households_data, persons_data, balancer='dual')
+        multipliers = allocator.multipliers
+        self.assertEqual(multipliers.lambdas.shape, (len(multipliers.tracts),
+                                                     len(multipliers.controls)))
+
+        warm_allocator = HouseholdAllocator.from_cleaned_data(
+            marginals, households_data, persons_data, balancer='ipf', multipliers=multipliers)
+        self.assertEqual(warm_allocator.allocated_households.shape, (114, 17))
+        numpy.testing.assert_allclose(
+            warm_allocator.multipliers.lambdas, multipliers.lambdas, atol=1e-3)
+
+        with self.assertRaises(ValueError) as raised:
+            HouseholdAllocator.from_cleaned_data(
+                marginals, households_data, persons_data, multipliers=multipliers)
+        self.assertIn("balancer='decomposed', 'dual' or 'ipf'", str(raised.exception))
+
+        # Multipliers survive writing and reloading the allocation
+        output_dir = tempfile.mkdtemp()
+        try:
+            household_file = os.path.join(output_dir, 'households.csv')
+            person_file = os.path.join(output_dir, 'persons.csv')
+            multipliers_file = os.path.join(output_dir, 'multipliers.npz')
+            allocator.write(household_file, person_file, multipliers_file=multipliers_file)
+            allocator_read = HouseholdAllocator.from_csvs(
+                household_file, person_file, multipliers_file=multipliers_file)
+            self.assertIsNone(HouseholdAllocator.from_csvs(
+                household_file, person_file).multipliers)
+            with self.assertRaises(ValueError):
+                HouseholdAllocator(
+                    allocator.allocated_households, allocator.allocated_persons
+                ).write(household_file, person_file, multipliers_file=multipliers_file)
+        finally:
+            shutil.rmtree(output_dir)
+        numpy.testing.assert_array_equal(
+            allocator_read.multipliers.tracts, numpy.asarray(multipliers.tracts, dtype=str))
+        numpy.testing.assert_array_equal(allocator_read.multipliers.lambdas, multipliers.lambdas)
+        numpy.testing.assert_array_equal(allocator_read.multipliers.nus, multipliers.nus)
+
+    def test_write_reports(self):
+        households_data = CleanedData(self._mock_household_data())
+        persons_data = CleanedData(self._mock_person_data())
+        marginals = Marginals(self._mock_tract_data())
+        allocator = HouseholdAllocator.from_cleaned_data(
+            marginals, households_data, persons_data, balancer='ipf', discretizer='trs')
+        # As left by a failed solve
+        allocator.reports['discretize'].primal_residual = float('nan')
+
+        def reject(constant):
+            raise ValueError('Invalid JSON constant {}'.format(constant))
+
+        output_dir = tempfile.mkdtemp()
+        try:
+            reports_file = os.path.join(output_dir, 'reports.json')
+            allocator.write_reports(reports_file)
+            with open(reports_file) as infile:
+                reports = json.load(infile, parse_constant=reject)
+        finally:
+            shutil.rmtree(output_dir)
+
+        self.assertEqual(list(reports.keys()), ['balance', 'discretize'])
+        self.assertEqual(reports['balance']['solver'], 'balance_multi_ipf')
+        self.assertEqual(reports['discretize']['solver'], 'discretize_multi_weights_trs')
+        self.assertIsNone(reports['discretize']['primal_residual'])
+        n_tracts = len(reports['balance']['tracts'])
+        n_controls = len(reports['balance']['controls'])
+        self.assertEqual(numpy.shape(reports['balance']['violations']), (n_tracts, n_controls))
+
+    def test_tract_multipliers(self):
+        multipliers = TractMultipliers(
+            numpy.array(['t1', 't2']), numpy.array(['a', 'b']),
+            numpy.array([[1., 2.], [3., 4.]]), numpy.array([5., 6.]))
+        output_dir = tempfile.mkdtemp()
+        try:
+            multipliers_file = os.path.join(output_dir, 'multipliers.npz')
+            multipliers.write(multipliers_file)
+            multipliers_read = TractMultipliers.from_file(multipliers_file)
+        finally:
+            shutil.rmtree(output_dir)
+        numpy.testing.assert_array_equal(multipliers_read.lambdas, multipliers.lambdas)
+
+        aligned = multipliers_read.align(['t2', 't3'], ['b', 'c', 'a'])
+        numpy.testing.assert_array_equal(aligned.lambdas, [[4., 0., 3.], [0., 0., 0.]])
+        numpy.testing.assert_array_equal(aligned.nus, [6., 0., 5.])
+
+    def test_incidence_matrix(self):
+        households = pandas.DataFrame({
+            'num_people_1': [1, 0, 0],
+            'num_people_2': [0, 1, 1],
+            'num_vehicles_0': [0, 0, 0],
+        })
+        columns = ['num_people_2', 'num_vehicles_0', 'num_people_1']
+        hh_table = HouseholdAllocator._incidence_matrix(households, columns)
+        self.assertEqual(hh_table.shape, (3, 3))
+        self.assertEqual(hh_table.nnz, 3)
+        numpy.testing.assert_array_equal(hh_table.toarray(), households[columns].values)
+
+    def test_get_counts(self):
+        allocated_households = pandas.DataFrame({
+            'serial_number': ['b', 'a', 'b', 'a', 'c'],
+            'count': [1, 0, 2, 3, 4],
+            'tract': ['t1', 't1', 't2', 't2', 't2'],
+        })
+        allocator = HouseholdAllocator(allocated_households, pandas.DataFrame())
+
+        counts = allocator.get_counts('a')
+        self.assertEqual(counts, [('t1', 0), ('t2', 3)])
+        for tract, count in counts:
+            self.assertIsInstance(count, int)
+        self.assertEqual(allocator.get_counts('missing'), [])
+
+        positions, rows, counts = allocator.get_counts_bulk(
+            numpy.array(['c', 'missing', 'b'], dtype=object))
+        self.assertSequenceEqual(positions.tolist(), [0, 2, 2])
+        self.assertSequenceEqual(rows.tolist(), [4, 0, 2])
+        self.assertSequenceEqual(counts.tract.tolist(), ['t2', 't1', 't2'])
+        self.assertSequenceEqual(counts.count.tolist(), [4, 1, 2])
+
+    def test_sample(self):
+        allocated_households = pandas.DataFrame({
+            'serial_number': ['a', 'b', 'a', 'b'],
+            'count': [10, 0, 20, 35],
+            'tract': ['t1', 't1', 't2', 't2'],
+        })
+        allocated_persons = pandas.DataFrame({'serial_number': ['a', 'b']})
+        allocator = HouseholdAllocator(allocated_households, allocated_persons)
+        sampled = allocator.sample(0.1, numpy.random.RandomState(0))
+
+        counts = sampled.allocated_households['count'].tolist()
+        self.assertSequenceEqual(counts[:3], [1, 0, 2])
+        self.assertIn(counts[3], (3, 4))
+        self.assertSequenceEqual(allocated_households['count'].tolist(), [10, 0, 20, 35])
+        self.assertIs(sampled.allocated_persons, allocated_persons)
+
     def test_read_from_file(self):
         read_csv = MagicMock(return_value=pandas.DataFrame())
         with patch('pandas.read_csv', read_csv):
             allocator = HouseholdAllocator.from_csvs('households_file', 'persons_file')
         assert type(allocator) == HouseholdAllocator
-        read_csv.assert_any_call('households_file')
-        read_csv.assert_any_call('persons_file')
+        read_csv.assert_any_call('households_file', compression='infer')
+        read_csv.assert_any_call('persons_file', compression='infer')
 
     def test_write_to_file(self):
         persons = MagicMock()
@@ -127,3 +324,37 @@ class TestAllocation(unittest.TestCase):
         allocator.write(person_file='persons_file', household_file='households_file')
         persons.to_csv.assert_called_once_with('persons_file')
         households.to_csv.assert_called_once_with('households_file')
+
+    @unittest.skipUnless(HAS_PYARROW, 'requires pyarrow')
+    def test_parquet_round_trip(self):
+        allocated_households = pandas.DataFrame({
+            'serial_number': ['a', 'b', 'a', 'b'],
+            'num_people': ['1', '2', '1', '2'],
+            'count': [1, 0, 2, 3],
+            'tract': ['t1', 't1', 't2', 't2'],
+        })
+        allocated_persons = pandas.DataFrame({
+            'serial_number': ['a', 'b', 'b'],
+            'age': ['18-34', '35-64', '0-17'],
+        })
+        multipliers = TractMultipliers(
+            numpy.array(['t1', 't2']), numpy.array(['num_people_1', 'num_people_2']),
+            numpy.array([[1., 2.], [3., 4.]]), numpy.array([5., 6.]))
+        allocator = HouseholdAllocator(allocated_households, allocated_persons, multipliers)
+        output_dir = tempfile.mkdtemp()
+        try:
+            household_file = os.path.join(output_dir, 'households.parquet')
+            person_file = os.path.join(output_dir, 'persons.parquet')
+            multipliers_file = os.path.join(output_dir, 'multipliers.npz')
+            allocator.write_parquet(household_file, person_file, multipliers_file)
+            allocator_read = HouseholdAllocator.from_parquet(
+                household_file, person_file, household_columns=[], tracts=['t2'],
+                multipliers_file=multipliers_file)
+        finally:
+            shutil.rmtree(output_dir)
+
+        self.assertSetEqual(
+            set(allocator_read.allocated_households.columns), {'serial_number', 'tract', 'count'})
+        self.assertSequenceEqual(allocator_read.allocated_households['count'].tolist(), [2, 3])
+        self.assertEqual(len(allocator_read.allocated_persons), 3)
+        numpy.testing.assert_array_equal(allocator_read.multipliers.nus, [5., 6.])
@@ -5,7 +5,9 @@ from __future__ import (
 )
 import unittest
 import math
+import os
 import sys
+import tempfile
 
 import pandas
 from mock import patch, mock_open
@@ -369,3 +371,21 @@ class BayesNetTests(unittest.TestCase):
             household_model_new = BayesianNetworkModel.from_file(
                 'file', self._household_segmenter())
             _check_network(household_model_new)
+
+    def test_read_file_segments(self):
+        household_model, _ = self._mock_household_collection()
+        handle, filename = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        try:
+            household_model.write(filename)
+            household_model_new = BayesianNetworkModel.from_file(
+                filename, self._household_segmenter())
+            self.assertSetEqual(set(household_model_new.type_to_network), {'1', '2'})
+            self._check_household_generate(household_model_new)
+
+            household_model_new = BayesianNetworkModel.from_file(
+                filename, self._household_segmenter(), segments=['2'])
+            self.assertSequenceEqual(household_model.fields, household_model_new.fields)
+            self.assertSetEqual(set(household_model_new.type_to_network), {'2'})
+        finally:
+            os.remove(filename)
@@ -0,0 +1,63 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+import pandas
+
+from doppelganger import compression
+
+
+class CompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_block_compressing_writer(self):
+        lines = ['row {}\n'.format(i) for i in range(1000)]
+        formats = [('gzip', gzip.open)]
+        if compression._MULTI_STREAM_BZ2:
+            formats.append(('bz2', bz2.BZ2File))
+        for name, open_fn in formats:
+            path = os.path.join(self.output_dir, 'out.' + name)
+            with compression.BlockCompressingWriter(path, name, threads=2,
+                                                    block_size=100) as writer:
+                for line in lines:
+                    writer.write(line)
+            infile = open_fn(path, 'rb')
+            try:
+                self.assertEqual(infile.read().decode('utf-8'), ''.join(lines))
+            finally:
+                infile.close()
+
+    def test_bz2_needs_multi_stream_reader(self):
+        with patch.object(compression, '_MULTI_STREAM_BZ2', False):
+            with self.assertRaises(ValueError):
+                compression.BlockCompressingWriter(
+                    os.path.join(self.output_dir, 'out.bz2'), 'bz2')
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            compression.BlockCompressingWriter(
+                os.path.join(self.output_dir, 'out'), 'rar')
+
+    def test_to_csv_round_trip(self):
+        dataframe = pandas.DataFrame({'tract': ['t1', 't2'] * 50, 'count': list(range(100))})
+        path = os.path.join(self.output_dir, 'out.csv.gz')
+        compression.to_csv(dataframe, path, 'gzip', index=False)
+        compression.to_csv(dataframe, path, 'gzip', mode='a', index=False, header=False)
+
+        dataframe_read = pandas.read_csv(path)
+        self.assertEqual(len(dataframe_read), 200)
+        self.assertSequenceEqual(dataframe_read['count'].tolist()[100:], list(range(100)))
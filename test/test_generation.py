@@ -6,10 +6,22 @@ from __future__ import (
 
 from mock import MagicMock, patch
 
+import io
+import os
+import shutil
+import tempfile
 import unittest
 import pandas
 
-from doppelganger import inputs, Population, HouseholdAllocator
+from doppelganger import (
+    columnar, inputs, populationgen, Population, HouseholdAllocator, Preprocessor
+)
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 
 class TestPopulationGen(unittest.TestCase):
@@ -46,8 +58,11 @@ class TestPopulationGen(unittest.TestCase):
         model = MagicMock()
         model.fields = fields
         model.segmenter = MagicMock(return_value='one_bucket')
+        # Returns the given rows, cycled to the requested count
         model.generate = MagicMock(
-            return_value=generated)
+            side_effect=lambda segment, evidence, count: [
+                generated[i % len(generated)] for i in range(count)
+            ])
         return model
 
     def _check_household_output(self, dataframe):
@@ -56,7 +71,7 @@ class TestPopulationGen(unittest.TestCase):
         self.assertSequenceEqual(
             dataframe[inputs.SERIAL_NUMBER.name].tolist(), ('b', 'b', 'b', 'b'))
         self.assertSequenceEqual(dataframe[inputs.REPEAT_INDEX.name].tolist(), (0, 1, 0, 1))
-        self.assertEqual(dataframe[inputs.HOUSEHOLD_ID.name].tolist()[0], 'tract1-b-0')
+        self.assertEqual(Population.household_id_strings(dataframe).tolist()[0], 'tract1-b-0')
 
     def _check_person_output(self, dataframe):
         self.assertSequenceEqual(
@@ -65,13 +80,12 @@ class TestPopulationGen(unittest.TestCase):
         self.assertSequenceEqual(
             dataframe[inputs.REPEAT_INDEX.name].tolist(), (0, 1, 0, 1, 0, 1, 0, 1))
         self.assertSequenceEqual(dataframe[inputs.AGE.name].tolist(), ['35-64'] * 8)
-        self.assertEqual(dataframe[inputs.HOUSEHOLD_ID.name].tolist()[0], 'tract1-b-0')
+        self.assertEqual(Population.household_id_strings(dataframe).tolist()[0], 'tract1-b-0')
 
     def test_generate_persons_simple(self):
         person_model = self._mock_model(
             [inputs.AGE.name, inputs.SEX.name],
-            # Returns two people regardles of count passed in
-            generated=[('35-64', 'F'), ('35-64', 'F')]
+            generated=[('35-64', 'F')]
         )
         allocations = self._mock_allocated()
         population = Population.generate(
@@ -79,14 +93,16 @@ class TestPopulationGen(unittest.TestCase):
 
         evidence = ((inputs.AGE.name, '35-64'), (inputs.SEX.name, 'M'))
 
+        # Repeats with the same evidence are sampled together, across tracts
+        self.assertEqual(person_model.generate.call_count, 2)
         person_model.generate.assert_called_with(
-            'one_bucket', evidence, count=2)
+            'one_bucket', evidence, count=4)
         self._check_person_output(population.generated_people)
 
     def test_generate_households_simple(self):
         household_model = self._mock_model(
             [inputs.NUM_PEOPLE.name],
-            generated=[('6+',), ('6+',)]
+            generated=[('6+',)]
         )
         allocations = self._mock_allocated()
         population = Population.generate(
@@ -94,19 +110,459 @@ class TestPopulationGen(unittest.TestCase):
 
         evidence = ((inputs.NUM_PEOPLE.name, '6+'),)
 
-        household_model.generate.assert_called_with(
-            'one_bucket', evidence, count=2)
+        household_model.generate.assert_called_once_with(
+            'one_bucket', evidence, count=4)
 
         self.assertIn(inputs.NUM_PEOPLE.name, population.generated_households)
         self._check_household_output(population.generated_households)
 
+    def test_household_ids(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        population = Population.generate(self._mock_allocated(), person_model, household_model)
+        people = population.generated_people
+        households = population.generated_households
+
+        self.assertEqual(households[inputs.HOUSEHOLD_ID.name].dtype, 'int64')
+        self.assertSetEqual(set(people[inputs.HOUSEHOLD_ID.name]),
+                            set(households[inputs.HOUSEHOLD_ID.name]))
+        tract_codes, serial_codes, repeat_ids = populationgen.unpack_household_ids(
+            households[inputs.HOUSEHOLD_ID.name])
+        self.assertSequenceEqual(tract_codes.tolist(), [0, 0, 1, 1])
+        self.assertSequenceEqual(serial_codes.tolist(), [0, 0, 0, 0])
+        self.assertSequenceEqual(repeat_ids.tolist(), [0, 1, 0, 1])
+
+        with self.assertRaises(ValueError):
+            populationgen.pack_household_ids([0], [0], [1 << populationgen.REPEAT_INDEX_BITS])
+
+    def test_generate_uses_allocator_index(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        allocated = self._mock_allocated()
+        Population.generate(allocated, person_model, MagicMock())
+        index = allocated._counts_index()
+        # The serial number index is built once and shared by later runs
+        with patch('doppelganger.allocation.SerialNumberIndex') as serial_number_index:
+            population = Population.generate(allocated, person_model, MagicMock())
+        serial_number_index.assert_not_called()
+        self.assertIs(allocated._counts_index(), index)
+        self._check_person_output(population.generated_people)
+
+    def test_household_ids_independent_of_row_order(self):
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        allocated = self._mock_allocated()
+        households = allocated.allocated_households
+        households.loc[1, inputs.SERIAL_NUMBER.name] = 'a'
+        reordered = HouseholdAllocator(
+            households.iloc[::-1].reset_index(drop=True), allocated.allocated_persons)
+
+        def household_ids(allocator):
+            generated = Population.generate(
+                allocator, MagicMock(), household_model).generated_households
+            return dict(zip(Population.household_id_strings(generated),
+                            generated[inputs.HOUSEHOLD_ID.name]))
+
+        ids = household_ids(HouseholdAllocator(households, allocated.allocated_persons))
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(household_ids(reordered), ids)
+
+    def test_generate_categorical(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        population = Population.generate(
+            self._mock_allocated(), person_model, MagicMock(), preprocessor=Preprocessor())
+        people = population.generated_people
+
+        for field in (inputs.TRACT, inputs.SERIAL_NUMBER, inputs.AGE, inputs.SEX):
+            self.assertEqual(people[field.name].dtype.name, 'category')
+        self.assertSequenceEqual(
+            people[inputs.AGE.name].cat.categories.tolist(), ['0-17', '18-34', '35-64', '65+'])
+        self.assertSequenceEqual(people[inputs.SEX.name].cat.categories.tolist(), ['F', 'M'])
+        self.assertSequenceEqual(people[inputs.TRACT.name].cat.categories.tolist(),
+                                 ['tract1', 'tract2'])
+        self.assertEqual(people[inputs.REPEAT_INDEX.name].dtype.itemsize, 1)
+
+    def test_generate_groups_identical_evidence(self):
+        allocations = self._mock_allocated()
+        allocations.allocated_households = pandas.concat([
+            allocations.allocated_households,
+            allocations.allocated_households.assign(serial_number='c', count=1),
+        ], ignore_index=True)
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        population = Population.generate(
+            allocations, MagicMock(), household_model)
+
+        # Serial numbers b and c share their evidence, so are sampled together
+        evidence = ((inputs.NUM_PEOPLE.name, '6+'),)
+        household_model.generate.assert_called_once_with(
+            'one_bucket', evidence, count=6)
+        self.assertSequenceEqual(
+            population.generated_households[inputs.SERIAL_NUMBER.name].tolist(),
+            ('b', 'b', 'b', 'b', 'c', 'c'))
+
+    def test_segments_per_distinct_combination(self):
+        data = pandas.DataFrame({
+            'num_people': ['1', '2', '1', '2', '1'],
+            'age': ['18-34', '18-34', '65+', '65+', '18-34'],
+            'serial_number': ['a', 'b', 'c', 'd', 'e'],
+        })
+        calls = []
+
+        def segmenter(row):
+            calls.append(row)
+            if row['num_people'] == '1':
+                return 'single'
+            return 'family_' + row['age']
+
+        segmenter_columns = {}
+        segments = Population._segments(data, segmenter, segmenter_columns)
+        self.assertSequenceEqual(
+            segments.tolist(),
+            ['single', 'family_18-34', 'single', 'family_65+', 'single'])
+        # Once per distinct value of the columns found so far, until the
+        # columns read stop growing: 1 + 2 (num_people) + 4 (num_people, age)
+        self.assertEqual(len(calls), 7)
+
+        # With the columns found, once per distinct (num_people, age)
+        del calls[:]
+        segments = Population._segments(data.iloc[::-1], segmenter, segmenter_columns)
+        self.assertSequenceEqual(
+            segments.tolist(),
+            ['single', 'family_65+', 'single', 'family_18-34', 'single'])
+        self.assertEqual(len(calls), 4)
+
+        # Segmenters doing more than key lookups are called on every row
+        segments = Population._segments(data, lambda row: row.num_people)
+        self.assertSequenceEqual(segments.tolist(), ['1', '2', '1', '2', '1'])
+
+    def test_generate_chunks(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        allocations = self._mock_allocated()
+        chunks = list(Population.generate_chunks(allocations, person_model, MagicMock()))
+
+        self.assertEqual(len(chunks), 2)
+        for chunk, tract in zip(chunks, ('tract1', 'tract2')):
+            self.assertSequenceEqual(
+                chunk.generated_people[inputs.TRACT.name].tolist(), [tract] * 4)
+        self.assertSequenceEqual(chunks[1].generated_people.index.tolist(), [4, 5, 6, 7])
+
+        chunks = list(Population.generate_chunks(
+            allocations, person_model, MagicMock(), chunk_size=10))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(len(chunks[0].generated_people), 8)
+
+    def test_generate_joined(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F'), ('18-34', 'M')]
+        )
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('1',), ('2',), ('3',)]
+        )
+        population = Population.generate(
+            self._mock_allocated(), person_model, household_model, joined=True)
+
+        merged = pandas.merge(
+            population.generated_people,
+            population.generated_households[[inputs.HOUSEHOLD_ID.name, inputs.NUM_PEOPLE.name]],
+            on=inputs.HOUSEHOLD_ID.name, how='left')
+        joined = population.generated_joined
+        self.assertSequenceEqual(joined.index.tolist(), population.generated_people.index.tolist())
+        self.assertSequenceEqual(
+            joined[inputs.NUM_PEOPLE.name].tolist(), merged[inputs.NUM_PEOPLE.name].tolist())
+        self.assertSequenceEqual(
+            joined[inputs.AGE.name].tolist(), population.generated_people[inputs.AGE.name].tolist())
+
+        self.assertIsNone(Population.generate(
+            self._mock_allocated(), person_model, household_model).generated_joined)
+
+    def test_write_joined_compressed(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        population = Population.generate(
+            self._mock_allocated(), person_model, household_model, joined=True)
+        output_dir = tempfile.mkdtemp()
+        try:
+            joined_file = os.path.join(output_dir, 'joined.csv.gz')
+            population.write_joined(joined_file, compression='gzip')
+            joined = pandas.read_csv(joined_file, compression='gzip', index_col=0)
+        finally:
+            shutil.rmtree(output_dir)
+
+        self.assertEqual(len(joined), 8)
+        self.assertSequenceEqual(joined[inputs.NUM_PEOPLE.name].tolist(), ['6+'] * 8)
+        self.assertEqual(joined[inputs.HOUSEHOLD_ID.name].tolist()[0], 'tract1-b-0')
+
+    def test_iter_tracts(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        lazy = Population.iter_tracts(self._mock_allocated(), person_model, MagicMock())
+
+        self.assertEqual(len(lazy), 2)
+        population = lazy.generate_tract('tract2')
+        self.assertSequenceEqual(
+            population.generated_people[inputs.TRACT.name].tolist(), ['tract2'] * 4)
+        self.assertEqual(
+            Population.household_id_strings(population.generated_people)[0], 'tract2-b-0')
+
+        # The segmenter is probed for the columns it reads on the first tract only
+        self.assertEqual(person_model.segmenter.call_count, 1)
+        tracts = [tract for tract, _ in lazy]
+        self.assertSequenceEqual(tracts, ['tract1', 'tract2'])
+        self.assertEqual(person_model.segmenter.call_count, 3)
+
+    def test_generate_parallel(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        population = Population.generate(
+            self._mock_allocated(), person_model, household_model, processes=2)
+
+        self._check_household_output(population.generated_households)
+        self.assertSequenceEqual(
+            population.generated_people[inputs.TRACT.name].tolist(),
+            ['tract1'] * 4 + ['tract2'] * 4)
+        self.assertSequenceEqual(population.generated_people.index.tolist(), list(range(8)))
+
+    def test_generate_chunks_parallel_matches_serial(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F'), ('18-34', 'M'), ('65+', 'F')]
+        )
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('1',), ('2',)]
+        )
+        allocated_persons = pandas.DataFrame({
+            inputs.SERIAL_NUMBER.name: ['c', 'b', 'c', 'b', 'd'],
+            inputs.AGE.name: ['18-34', '35-64', '65+', '35-64', '18-34'],
+            inputs.SEX.name: ['M', 'F', 'F', 'M', 'F'],
+            inputs.INDIVIDUAL_INCOME.name: ['None', '40k+', 'None', 'None', '40k+'],
+        })
+        allocated_households = pandas.DataFrame({
+            inputs.SERIAL_NUMBER.name: ['b', 'c', 'd'] * 7,
+            inputs.NUM_PEOPLE.name: ['2', '2', '1'] * 7,
+            inputs.COUNT.name: [1, 2, 0, 3, 0, 1, 2, 2, 1, 0, 1, 1, 3, 0, 2, 1, 1, 1, 2, 0, 1],
+            inputs.TRACT.name: ['tract{}'.format(i // 3) for i in range(21)],
+        })
+        allocations = HouseholdAllocator(allocated_households, allocated_persons)
+
+        def generate(processes):
+            chunks = list(Population.generate_chunks(
+                allocations, person_model, household_model, chunk_size=2,
+                processes=processes))
+            return (pandas.concat([chunk.generated_people for chunk in chunks]),
+                    pandas.concat([chunk.generated_households for chunk in chunks]))
+
+        serial_people, serial_households = generate(1)
+        parallel_people, parallel_households = generate(2)
+        self.assertEqual(len(serial_households), 25)
+        pandas.testing.assert_frame_equal(parallel_people, serial_people)
+        pandas.testing.assert_frame_equal(parallel_households, serial_households)
+
+    def test_apply_in_order_bounds_pending(self):
+        submitted = []
+
+        class SyncResult(object):
+            def __init__(self, value):
+                self.value = value
+
+            def get(self):
+                return self.value
+
+        pool = MagicMock()
+        pool.apply_async = MagicMock(side_effect=lambda func, args: (
+            submitted.append(args[0]) or SyncResult(func(*args))))
+
+        results = populationgen._apply_in_order(pool, lambda x: x * 2, range(10), 3)
+        self.assertEqual(next(results), 0)
+        self.assertEqual(submitted, [0, 1, 2])
+        self.assertEqual(list(results), [2 * x for x in range(1, 10)])
+
+    def test_generate_to_csvs(self):
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        allocations = self._mock_allocated()
+        output_dir = tempfile.mkdtemp()
+        try:
+            persons_file = os.path.join(output_dir, 'persons.csv')
+            households_file = os.path.join(output_dir, 'households.csv')
+            Population.generate_to_csvs(
+                allocations, MagicMock(), household_model, persons_file, households_file)
+            population = Population.from_csvs(persons_file, households_file)
+        finally:
+            shutil.rmtree(output_dir)
+
+        self._check_household_output(population.generated_households)
+        self.assertSequenceEqual(
+            population.generated_households['Unnamed: 0'].tolist(), [0, 1, 2, 3])
+        self.assertEqual(
+            population.generated_households[inputs.HOUSEHOLD_ID.name][0], 'tract1-b-0')
+
+    def test_generate_to_compressed_csvs(self):
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        allocations = self._mock_allocated()
+        output_dir = tempfile.mkdtemp()
+        try:
+            persons_file = os.path.join(output_dir, 'persons.csv.gz')
+            households_file = os.path.join(output_dir, 'households.csv.gz')
+            Population.generate_to_csvs(
+                allocations, MagicMock(), household_model, persons_file, households_file,
+                compression='gzip')
+            population = Population.from_csvs(persons_file, households_file)
+        finally:
+            shutil.rmtree(output_dir)
+
+        self._check_household_output(population.generated_households)
+        self.assertSequenceEqual(
+            population.generated_households['Unnamed: 0'].tolist(), [0, 1, 2, 3])
+
+    @unittest.skipUnless(HAS_PYARROW, 'requires pyarrow')
+    def test_parquet_round_trip(self):
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        population = Population.generate(self._mock_allocated(), MagicMock(), household_model)
+        output_dir = tempfile.mkdtemp()
+        try:
+            persons_file = os.path.join(output_dir, 'persons.parquet')
+            households_file = os.path.join(output_dir, 'households.parquet')
+            population.write_parquet(persons_file, households_file, string_ids=False)
+
+            population_read = Population.from_parquet(persons_file, households_file)
+            self._check_household_output(population_read.generated_households)
+            self.assertEqual(
+                population_read.generated_households[inputs.NUM_PEOPLE.name].dtype.name,
+                'category')
+
+            population_read = Population.from_parquet(
+                persons_file, households_file,
+                household_columns=[inputs.HOUSEHOLD_ID.name], tracts=['tract2'])
+        finally:
+            shutil.rmtree(output_dir)
+
+        households = population_read.generated_households
+        self.assertSequenceEqual(households.columns.tolist(), [inputs.HOUSEHOLD_ID.name])
+        tract_codes, _, repeat_ids = populationgen.unpack_household_ids(
+            households[inputs.HOUSEHOLD_ID.name])
+        self.assertSequenceEqual(tract_codes.tolist(), [1, 1])
+        self.assertSequenceEqual(repeat_ids.tolist(), [0, 1])
+
+    @unittest.skipUnless(HAS_PYARROW, 'requires pyarrow')
+    def test_generate_to_arrow_streams(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        persons_sink = io.BytesIO()
+        read_fd, write_fd = os.pipe()
+        try:
+            Population.generate_to_arrow_streams(
+                self._mock_allocated(), person_model, household_model, persons_sink, write_fd)
+            os.close(write_fd)
+            with io.open(read_fd, 'rb') as households_source:
+                households = list(columnar.iter_arrow_stream(households_source))
+        finally:
+            for fd in (read_fd, write_fd):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+        self.assertEqual(len(households), 2)
+        self._check_household_output(pandas.concat(households, ignore_index=True))
+
+        persons = list(columnar.iter_arrow_stream(io.BytesIO(persons_sink.getvalue())))
+        self.assertSequenceEqual([len(chunk) for chunk in persons], [4, 4])
+        self.assertEqual(persons[0][inputs.AGE.name].tolist(), ['35-64'] * 4)
+
+    def test_write_partitioned(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F')]
+        )
+        household_model = self._mock_model(
+            [inputs.NUM_PEOPLE.name],
+            generated=[('6+',)]
+        )
+        population = Population.generate(self._mock_allocated(), person_model, household_model)
+        marginals = MagicMock(data=pandas.DataFrame({
+            'STATEFP': ['29', '29'],
+            'COUNTYFP': ['047', '095'],
+            'TRACTCE': ['tract1', 'tract2'],
+        }))
+        output_dir = tempfile.mkdtemp()
+        try:
+            manifest = population.write_partitioned(output_dir, marginals, threads=2)
+            self.assertTrue(os.path.exists(os.path.join(
+                output_dir, 'state=29', 'county=095', 'tract=tract2', 'persons.csv')))
+            population_read = Population.from_partitioned(output_dir, counties=['095'])
+        finally:
+            shutil.rmtree(output_dir)
+
+        self.assertSequenceEqual(
+            [partition['tract'] for partition in manifest['partitions']], ['tract1', 'tract2'])
+        files = manifest['partitions'][1]['files']
+        self.assertEqual(files['persons']['rows'], 4)
+        self.assertEqual(files['households']['rows'], 2)
+        self.assertGreater(files['households']['bytes'], 0)
+
+        households = population_read.generated_households
+        self.assertSequenceEqual(households[inputs.TRACT.name].tolist(), ['tract2'] * 2)
+        self.assertSequenceEqual(households.index.tolist(), [2, 3])
+        self.assertEqual(households[inputs.HOUSEHOLD_ID.name].iloc[0], 'tract2-b-0')
+        self.assertEqual(len(population_read.generated_people), 4)
+
     def test_read_from_file(self):
         read_csv = MagicMock(return_value=pandas.DataFrame())
         with patch('pandas.read_csv', read_csv):
             population = Population.from_csvs('persons_file', 'households_file')
         assert type(population) == Population
-        read_csv.assert_any_call('households_file')
-        read_csv.assert_any_call('persons_file')
+        read_csv.assert_any_call('households_file', compression='infer')
+        read_csv.assert_any_call('persons_file', compression='infer')
 
     def test_write_to_file(self):
         persons = MagicMock()
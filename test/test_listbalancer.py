@@ -4,8 +4,13 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
+import json
 import unittest
+import cvxpy as cvx
+from mock import patch
 import numpy as np
+import scipy.optimize
+import scipy.sparse
 
 from doppelganger import listbalancer
 
@@ -238,6 +243,102 @@ class ListBalancerTests(unittest.TestCase):
             for expected_weights in expected_weights_options)
         )
 
+    def test_balance_ipf(self):
+        hh_table, A, w, _, expected_weights = self._mock_list_consistent()
+        hh_weights = listbalancer.balance_ipf(hh_table, A, w)
+        np.testing.assert_allclose(
+            hh_weights, expected_weights, rtol=0.01, atol=0)
+
+    def test_balance_ipf_relaxed(self):
+        hh_table, A, w, mu, _ = self._mock_list_relaxed()
+        hh_weights, z = listbalancer.balance_ipf(hh_table, A, w, mu)
+        expected_weights, expected_z = listbalancer.balance_cvx(hh_table, A, w, mu)
+        np.testing.assert_allclose(hh_weights, expected_weights, rtol=0.01, atol=0)
+        np.testing.assert_allclose(z, expected_z, rtol=0.01, atol=0)
+
+    def test_balance_multi_ipf(self):
+        hh_table, A, w, mu, expected_weights = self._mock_list_inconsistent()
+
+        # Extend the data, with a tract of zero marginals
+        n_tracts = 10
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        A_extend[3] = 0
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = np.mat(np.tile(mu, (n_tracts, 1)))
+        B = np.mat(np.dot(np.ones((1, n_tracts)), A_extend)[0])
+        expected_weights_extend = np.mat(np.tile(expected_weights, (n_tracts, 1)))
+        expected_weights_extend[3] = 0
+        gamma = 1000.
+        meta_gamma = 1000.
+        hh_weights = listbalancer.balance_multi_ipf(
+            hh_table, A_extend, B, w_extend, gamma * mu_extend.T, meta_gamma)
+        np.testing.assert_allclose(
+            hh_weights, expected_weights_extend, rtol=0.01, atol=0)
+
+    def test_balance_multi_ipf_trust_initial(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        B = np.mat(np.dot(np.ones((1, 1)), A)[0])
+        gamma = 1.
+        hh_weights = listbalancer.balance_multi_ipf(
+            hh_table, A, B, w, gamma * mu.T
+        )
+        np.testing.assert_allclose(
+            hh_weights, w, rtol=0.05, atol=0)
+
+    def test_balance_multi_dual(self):
+        hh_table, A, w, mu, expected_weights = self._mock_list_inconsistent()
+
+        # Extend the data, with a tract of zero marginals
+        n_tracts = 10
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        A_extend[3] = 0
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = np.mat(np.tile(mu, (n_tracts, 1)))
+        B = np.mat(np.dot(np.ones((1, n_tracts)), A_extend)[0])
+        gamma = 1000.
+        meta_gamma = 1000.
+        hh_weights = listbalancer.balance_multi_dual(
+            hh_table, A_extend, B, w_extend, gamma * mu_extend.T, meta_gamma)
+        expected_weights_extend = listbalancer.balance_multi_cvx(
+            hh_table, A_extend, B, w_extend, gamma * mu_extend.T, meta_gamma)
+        np.testing.assert_allclose(
+            hh_weights, expected_weights_extend, rtol=0.01, atol=0.01)
+
+    def test_balance_multi_dual_trust_controls(self):
+        hh_table, A, w, mu, expected_weights = self._mock_list_consistent()
+        B = np.mat(np.dot(np.ones((1, 1)), A)[0])
+        gamma = 100000.
+        hh_weights = listbalancer.balance_multi_dual(
+            hh_table, A, B, w, gamma * mu.T
+        )
+        np.testing.assert_allclose(
+            hh_weights, expected_weights.T, rtol=0.05, atol=0)
+
+    def test_balance_multi_warm_start(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        n_tracts = 3
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        A_extend[1] = 0
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = 1000. * np.mat(np.tile(mu, (n_tracts, 1))).T
+        B = np.mat(np.sum(A_extend, axis=0))
+        hh_weights, multipliers = listbalancer.balance_multi_cvx(
+            hh_table, A_extend, B, w_extend, mu_extend, 1000., full_output=True)
+        np.testing.assert_array_equal(multipliers.lambdas[1], 0)
+
+        for balance in (listbalancer.balance_multi_ipf, listbalancer.balance_multi_dual):
+            warm_weights, warm_multipliers = balance(
+                hh_table, A_extend, B, w_extend, mu_extend, 1000.,
+                multipliers=multipliers, full_output=True)
+            np.testing.assert_allclose(warm_weights, hh_weights, rtol=1e-3, atol=1e-3)
+            np.testing.assert_allclose(warm_multipliers.nus, multipliers.nus, atol=1e-3)
+            # The multipliers give the weights in closed form, from the
+            # initial weights scaled by each of the two tracts' share
+            closed_form = np.multiply(
+                w_extend / 2, np.exp(np.dot(warm_multipliers.lambdas, hh_table.T)))
+            closed_form[1] = 0
+            np.testing.assert_allclose(warm_weights, closed_form, rtol=1e-6)
+
     def test_balance_multi_cvx(self):
         hh_table, A, w, mu, expected_weights = self._mock_list_inconsistent()
 
@@ -256,6 +357,198 @@ class ListBalancerTests(unittest.TestCase):
         np.testing.assert_allclose(
             hh_weights, expected_weights_extend, rtol=0.01, atol=0)
 
+    def test_balance_multi_cvx_cached_problem(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        A_extend = np.mat(np.tile(A, (2, 1)))
+        A_scaled = np.mat(np.multiply(A_extend, [[1.], [2.]]))
+        w_extend = np.mat(np.tile(w, (2, 1)))
+        mu_extend = 1000. * np.mat(np.tile(mu, (2, 1))).T
+
+        def balance(A):
+            B = np.mat(np.sum(A, axis=0))
+            return listbalancer.balance_multi_cvx(hh_table, A, B, w_extend, mu_extend, 1000.)
+
+        listbalancer._cvx_problems.clear()
+        expected_weights = balance(A_scaled)
+
+        balance(A_extend)
+        problem = listbalancer._multi_balance_problem(2, *hh_table.shape)
+        # Same shape, other marginals: the compiled problem is reused
+        hh_weights = balance(A_scaled)
+        self.assertIs(listbalancer._multi_balance_problem(2, *hh_table.shape), problem)
+        np.testing.assert_allclose(hh_weights, expected_weights, rtol=1e-6)
+
+    def test_multi_balance_problem_cache_size(self):
+        for n_tracts in range(1, listbalancer.CVX_CACHE_SIZE + 2):
+            listbalancer._multi_balance_problem(n_tracts, 3, 2)
+        self.assertEqual(len(listbalancer._cvx_problems), listbalancer.CVX_CACHE_SIZE)
+        self.assertNotIn((1, 3, 2), listbalancer._cvx_problems)
+
+    def test_balance_multi_cvx_sparse_uncached(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        A_extend = np.mat(np.tile(A, (2, 1)))
+        w_extend = np.mat(np.tile(w, (2, 1)))
+        mu_extend = 1000. * np.mat(np.tile(mu, (2, 1))).T
+        B = np.mat(np.sum(A_extend, axis=0))
+        sparse_table = scipy.sparse.csr_matrix(hh_table)
+
+        listbalancer._cvx_problems.clear()
+        hh_weights = listbalancer.balance_multi_cvx(
+            sparse_table, A_extend, B, w_extend, mu_extend, 1000.)
+        # Sparse tables are not densified into a cached problem's Parameter
+        self.assertEqual(len(listbalancer._cvx_problems), 0)
+        np.testing.assert_allclose(
+            hh_weights,
+            listbalancer.balance_multi_cvx(hh_table, A_extend, B, w_extend, mu_extend, 1000.),
+            rtol=1e-3, atol=1e-3)
+
+    def test_balance_multi_report(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        n_tracts = 3
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = 1000. * np.mat(np.tile(mu, (n_tracts, 1))).T
+        B = np.mat(np.sum(A_extend, axis=0))
+        for balance in (listbalancer.balance_multi_cvx,
+                        listbalancer.balance_multi_ipf,
+                        listbalancer.balance_multi_dual):
+            report = listbalancer.SolveReport()
+            hh_weights = balance(hh_table, A_extend, B, w_extend, mu_extend, 1000., report=report)
+            self.assertEqual(report.solver, balance.__name__)
+            self.assertEqual(report.status, 'optimal')
+            self.assertEqual(
+                (report.n_tracts, report.n_samples, report.n_controls), (3, 4, 5))
+            self.assertGreater(report.iterations, 0)
+            self.assertGreaterEqual(report.solve_time, 0)
+            self.assertLess(report.primal_residual, 1e-2)
+            self.assertLess(report.dual_residual, 1e-2)
+            np.testing.assert_allclose(
+                report.violations, np.dot(hh_weights, hh_table) - A_extend, atol=1e-9)
+
+        report_dict = json.loads(report.to_json())
+        self.assertEqual(report_dict['solver'], 'balance_multi_dual')
+        self.assertEqual(np.shape(report_dict['violations']), (3, 5))
+
+    def test_failed_solve_report_json(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        A_extend = np.mat(np.tile(A, (2, 1)))
+        w_extend = np.mat(np.tile(w, (2, 1)))
+        mu_extend = 1000. * np.mat(np.tile(mu, (2, 1))).T
+        B = np.mat(np.sum(A_extend, axis=0))
+
+        # A line search that diverged
+        diverged = scipy.optimize.OptimizeResult(
+            x=np.full(A_extend.size + A_extend.shape[1], np.nan), nit=3, success=False,
+            message='ABNORMAL_TERMINATION_IN_LNSRCH')
+        report = listbalancer.SolveReport()
+        with patch.object(listbalancer.scipy.optimize, 'minimize', return_value=diverged):
+            listbalancer.balance_multi_dual(
+                hh_table, A_extend, B, w_extend, mu_extend, 1000., report=report)
+        self.assertEqual(report.status, 'not_converged')
+        self.assertTrue(np.isnan(report.primal_residual))
+
+        def reject(constant):
+            raise ValueError('Invalid JSON constant {}'.format(constant))
+
+        report_dict = json.loads(report.to_json(), parse_constant=reject)
+        self.assertIsNone(report_dict['primal_residual'])
+        self.assertIsNone(report_dict['violations'][0][0])
+        self.assertEqual(report_dict['iterations'], 3)
+
+    def test_discretize_multi_weights_report(self):
+        hh_table, hh_weights, _ = self._mock_hh_weights()
+        for discretize in (listbalancer.discretize_multi_weights,
+                           listbalancer.discretize_multi_weights_trs):
+            report = listbalancer.SolveReport()
+            hh_discretized = discretize(hh_table, hh_weights, report=report)
+            self.assertEqual(report.status, 'optimal')
+            np.testing.assert_allclose(
+                report.violations,
+                np.dot(hh_weights.astype(int) + hh_discretized - hh_weights, hh_table))
+
+    def test_balance_multi_decomposed(self):
+        hh_table, A, w, mu, expected_weights = self._mock_list_inconsistent()
+
+        # Extend the data, with a tract of zero marginals
+        n_tracts = 5
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        A_extend[2] = 0
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = np.mat(np.tile(mu, (n_tracts, 1)))
+        B = np.mat(np.dot(np.ones((1, n_tracts)), A_extend)[0])
+        gamma = 1000.
+        meta_gamma = 1000.
+        report = listbalancer.SolveReport()
+        hh_weights = listbalancer.balance_multi_decomposed(
+            hh_table, A_extend, B, w_extend, gamma * mu_extend.T, meta_gamma,
+            tracts_per_block=2, processes=2, report=report)
+
+        self.assertEqual(hh_weights.shape, w_extend.shape)
+        self.assertEqual(report.status, 'optimal')
+        np.testing.assert_array_equal(hh_weights[2], np.zeros((1, 4)))
+        expected_weights = listbalancer.balance_multi_cvx(
+            hh_table, A_extend, B, w_extend, gamma * mu_extend.T, meta_gamma)
+        np.testing.assert_allclose(
+            hh_weights, expected_weights, rtol=0.01, atol=0.01)
+
+    def test_balance_multi_decomposed_meta_marginals(self):
+        hh_table, A, w, mu, expected_weights = self._mock_list_inconsistent()
+
+        # Tracts of different sizes whose marginals disagree with the
+        # meta-marginals, so the blocks must trade off against each other
+        n_tracts = 4
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        A_extend[1] *= 2
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = np.mat(np.tile(mu, (n_tracts, 1)))
+        B = 1.1 * np.mat(np.dot(np.ones((1, n_tracts)), A_extend)[0])
+        gamma = 1000.
+        meta_gamma = 1000.
+        hh_weights = listbalancer.balance_multi_decomposed(
+            hh_table, A_extend, B, w_extend, gamma * mu_extend.T, meta_gamma,
+            tracts_per_block=1, processes=1)
+
+        expected_weights = listbalancer.balance_multi_cvx(
+            hh_table, A_extend, B, w_extend, gamma * mu_extend.T, meta_gamma)
+        np.testing.assert_allclose(hh_weights, expected_weights, rtol=1e-3, atol=1e-3)
+        # The larger meta-marginals pull the fitted totals up
+        consistent_weights = listbalancer.balance_multi_decomposed(
+            hh_table, A_extend, B / 1.1, w_extend, gamma * mu_extend.T, meta_gamma,
+            tracts_per_block=1, processes=1)
+        self.assertGreater(
+            np.sum(np.dot(hh_weights, hh_table)),
+            np.sum(np.dot(consistent_weights, hh_table)) + 1)
+
+    def test_balance_multi_decomposed_multipliers(self):
+        hh_table, A, w, mu, expected_weights = self._mock_list_inconsistent()
+
+        n_tracts = 4
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        A_extend[1] *= 2
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = np.mat(np.tile(mu, (n_tracts, 1)))
+        B = 1.1 * np.mat(np.dot(np.ones((1, n_tracts)), A_extend)[0])
+        hh_weights, multipliers = listbalancer.balance_multi_decomposed(
+            hh_table, A_extend, B, w_extend, 1000. * mu_extend.T, 1000.,
+            processes=1, full_output=True)
+        _, dual_multipliers = listbalancer.balance_multi_dual(
+            hh_table, A_extend, B, w_extend, 1000. * mu_extend.T, 1000., full_output=True)
+        np.testing.assert_allclose(
+            multipliers.lambdas, dual_multipliers.lambdas, rtol=1e-2, atol=1e-3)
+        np.testing.assert_allclose(multipliers.nus, dual_multipliers.nus, rtol=1e-2, atol=1e-3)
+
+        # Starting from the solution, one round confirms it
+        report = listbalancer.SolveReport()
+        warm_weights = listbalancer.balance_multi_decomposed(
+            hh_table, A_extend, B, w_extend, 1000. * mu_extend.T, 1000.,
+            processes=1, max_rounds=1, multipliers=multipliers, report=report)
+        self.assertEqual(report.status, 'optimal')
+        np.testing.assert_allclose(warm_weights, hh_weights, rtol=1e-4)
+
+        with self.assertRaises(ValueError):
+            listbalancer.balance_multi_decomposed(
+                hh_table, A_extend, B, w_extend, 1000. * mu_extend.T, 1000., max_rounds=0)
+
     def test_balance_multi_cvx_infeasible(self):
         hh_table, A, w, mu, expected_weights = self._mock_list_infeasible()
 
@@ -274,6 +567,87 @@ class ListBalancerTests(unittest.TestCase):
         np.testing.assert_allclose(
             hh_weights, expected_weights_extend, rtol=0.01, atol=0)
 
+    def test_balance_multi_cvx_relaxation(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        n_tracts = 2
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = 1000. * np.mat(np.tile(mu, (n_tracts, 1))).T
+        B = np.mat(np.sum(A_extend, axis=0))
+
+        solve = cvx.Problem.solve
+        failures = [cvx.SolverError, cvx.SolverError]
+
+        def fail_twice(problem, *args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return solve(problem, *args, **kwargs)
+
+        report = listbalancer.SolveReport()
+        with patch.object(cvx.Problem, 'solve', autospec=True, side_effect=fail_twice):
+            hh_weights = listbalancer.balance_multi_cvx(
+                hh_table, A_extend, B, w_extend, mu_extend, 1000., report=report)
+        self.assertEqual(report.relaxations, 2)
+        self.assertEqual(report.bisections, 3)
+        problem = listbalancer._multi_balance_problem(n_tracts, *hh_table.shape)
+        # Bisected from 10 back toward the failing 100
+        np.testing.assert_allclose(problem.mu.value, 10. ** (1 + 7. / 8))
+        self.assertTrue(np.any(hh_weights))
+
+    def test_balance_multi_cvx_relaxation_accuracy(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        n_tracts = 2
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = 1000. * np.mat(np.tile(mu, (n_tracts, 1))).T
+        B = np.mat(np.sum(A_extend, axis=0))
+
+        listbalancer._cvx_problems.clear()
+        problem = listbalancer._multi_balance_problem(n_tracts, *hh_table.shape)
+        solve = cvx.Problem.solve
+
+        def fail_above_60(cvx_problem, *args, **kwargs):
+            if np.max(problem.mu.value) > 60:
+                raise cvx.SolverError
+            return solve(cvx_problem, *args, **kwargs)
+
+        def max_violation():
+            report = listbalancer.SolveReport()
+            with patch.object(cvx.Problem, 'solve', autospec=True, side_effect=fail_above_60):
+                listbalancer.balance_multi_cvx(
+                    hh_table, A_extend, B, w_extend, mu_extend, 1000., report=report)
+            self.assertEqual(report.status, 'optimal')
+            return report, np.max(problem.mu.value)
+
+        report, _ = max_violation()
+        violation = np.max(np.abs(report.violations))
+        # Relaxed from 1000 to 100 to 10, then bisected toward 100, where the
+        # last attempt fails again without counting as a relaxation
+        self.assertEqual(report.relaxations, 2)
+        self.assertEqual(report.bisections, 3)
+        # The old schedule only divides by RELAXATION_FACTOR, down to 10
+        with patch.object(listbalancer, 'RELAXATION_BISECTIONS', 0):
+            old_report, old_mu = max_violation()
+        old_violation = np.max(np.abs(old_report.violations))
+        self.assertEqual(old_mu, 10.)
+        self.assertEqual(old_report.relaxations, 2)
+        self.assertEqual(old_report.bisections, 0)
+        self.assertLess(violation, old_violation)
+
+    def test_unfittable_controls(self):
+        hh_table, A, w, _, _ = self._mock_list_infeasible()
+        A_extend = np.mat(np.tile(A, (2, 1)))
+        A_extend[1, 0] = 0
+        unfittable = listbalancer._unfittable_controls(hh_table, A_extend, np.tile(w, (2, 1)))
+        # Only the first household has a weight, and it counts controls 0 and 3
+        np.testing.assert_array_equal(unfittable, [
+            [False, False],
+            [True, True],
+            [True, True],
+            [False, False],
+            [True, True],
+        ])
+
     def test_balance_multi_trust_initial(self):
         hh_table, A, w, mu, _ = self._mock_list_inconsistent()
         B = np.mat(np.dot(np.ones((1, 1)), A)[0])
@@ -319,3 +693,109 @@ class ListBalancerTests(unittest.TestCase):
             hh_table, hh_weights)
         np.testing.assert_array_equal(
             hh_discretized, expected_hh_discretized)
+
+    def test_discretize_multi_weights_sparse(self):
+        hh_table, hh_weights, expected_hh_discretized = self._mock_hh_weights()
+        hh_discretized = listbalancer.discretize_multi_weights(
+            scipy.sparse.csr_matrix(hh_table), hh_weights)
+        np.testing.assert_array_equal(
+            hh_discretized, expected_hh_discretized)
+
+    def test_discretize_multi_weights_trs(self):
+        hh_table, hh_weights, _ = self._mock_hh_weights()
+        random_state = np.random.RandomState(0)
+        residuals = hh_weights - hh_weights.astype(int)
+        draws = np.array([
+            listbalancer.discretize_multi_weights_trs(hh_table, hh_weights, random_state)
+            for _ in range(5000)
+        ])
+        # Each tract draws 2 or 3 of its residual total of 2.41
+        self.assertTrue(np.in1d(draws.sum(axis=2), [2, 3]).all())
+        self.assertTrue(((draws == 0) | (draws == 1)).all())
+        # Household weights and tract totals are unbiased
+        np.testing.assert_allclose(draws.mean(axis=0), residuals, atol=0.02)
+        np.testing.assert_allclose(draws.sum(axis=2).mean(axis=0), [2.41, 2.41], atol=0.03)
+
+    def test_discretize_multi_weights_trs_empty(self):
+        report = listbalancer.SolveReport()
+        hh_discretized = listbalancer.discretize_multi_weights_trs(
+            np.zeros((0, 5)), np.zeros((2, 0)), report=report)
+        self.assertEqual(hh_discretized.shape, (2, 0))
+        self.assertEqual(report.solver, 'discretize_multi_weights_trs')
+        self.assertEqual(report.status, 'optimal')
+        self.assertEqual((report.n_tracts, report.n_samples, report.n_controls), (2, 0, 5))
+
+    def test_discretize_multi_zero_weights_trs(self):
+        hh_table, hh_weights, expected_hh_discretized = self._mock_hh_weights_zeroed()
+        hh_discretized = listbalancer.discretize_multi_weights_trs(
+            scipy.sparse.csr_matrix(hh_table), hh_weights, np.random.RandomState(0))
+        self.assertIn(hh_discretized[1].sum(), (2, 3))
+        np.testing.assert_array_equal(hh_discretized[[0, 2]], 0)
+
+    def test_balance_multi_sparse(self):
+        hh_table, A, w, mu, expected_weights = self._mock_list_inconsistent()
+
+        n_tracts = 3
+        A_extend = np.mat(np.tile(A, (n_tracts, 1)))
+        w_extend = np.mat(np.tile(w, (n_tracts, 1)))
+        mu_extend = np.mat(np.tile(mu, (n_tracts, 1)))
+        B = np.mat(np.dot(np.ones((1, n_tracts)), A_extend)[0])
+        sparse_table = scipy.sparse.csr_matrix(hh_table)
+        for balance in (listbalancer.balance_multi_cvx,
+                        listbalancer.balance_multi_ipf,
+                        listbalancer.balance_multi_dual):
+            dense_weights = balance(
+                hh_table, A_extend, B, w_extend, 1000. * mu_extend.T, 1000.)
+            sparse_weights = balance(
+                sparse_table, A_extend, B, w_extend, 1000. * mu_extend.T, 1000.)
+            np.testing.assert_allclose(sparse_weights, dense_weights, rtol=1e-3, atol=1e-3)
+
+    def test_collapse_household_types(self):
+        hh_table = scipy.sparse.csr_matrix(np.mat([
+            [1, 0, 1],
+            [0, 1, 1],
+            [1, 0, 1],
+            [1, 0, 2],
+        ]))
+        w = np.mat([[1., 2., 3., 4.], [0., 1., 0., 1.]])
+        type_table, type_w, types = listbalancer.collapse_household_types(hh_table, w)
+        self.assertEqual(type_table.shape, (3, 3))
+        np.testing.assert_array_equal(type_table[types].toarray(), hh_table.toarray())
+        np.testing.assert_array_equal(type_w.sum(axis=1), [10., 2.])
+        np.testing.assert_array_equal(type_w[:, types[0]], [4., 0.])
+
+        expanded = listbalancer.expand_household_types(2 * type_w, w, types)
+        np.testing.assert_allclose(expanded, 2 * w)
+
+    def test_balance_multi_cvx_collapsed(self):
+        hh_table, A, w, mu, _ = self._mock_list_inconsistent()
+        # Every household twice, with different weights
+        hh_table = np.vstack([hh_table, hh_table])
+        w = np.hstack([w, 2 * w])
+
+        type_table, type_w, types = listbalancer.collapse_household_types(hh_table, w)
+        type_weights = listbalancer.balance_multi_cvx(
+            type_table, A, A, type_w, 1000. * mu.T, 1000.)
+        hh_weights = listbalancer.expand_household_types(type_weights, w, types)
+        full_weights = listbalancer.balance_multi_cvx(
+            hh_table, A, A, w, 1000. * mu.T, 1000.)
+        np.testing.assert_allclose(hh_weights, full_weights, rtol=0.01)
+
+    def test_scale_weights(self):
+        weights = np.array([[0, 1, 10, 15], [100, 3, 7, 1000]])
+        scaled = listbalancer.scale_weights(weights, 0.1, np.random.RandomState(0))
+        self.assertEqual(scaled.shape, weights.shape)
+        # Exact multiples are kept, others are rounded down or up
+        np.testing.assert_array_equal(
+            [scaled[0, 0], scaled[0, 2], scaled[1, 0], scaled[1, 3]], [0, 1, 10, 100])
+        self.assertTrue(np.all(scaled >= np.floor(weights * 0.1)))
+        self.assertTrue(np.all(scaled <= np.ceil(weights * 0.1)))
+
+    def test_scale_weights_unbiased(self):
+        weights = np.full(100000, 3)
+        scaled = listbalancer.scale_weights(weights, 0.25, np.random.RandomState(0))
+        self.assertAlmostEqual(scaled.mean(), 0.75, places=2)
+
+    def test_scale_weights_invalid_fraction(self):
+        with self.assertRaises(ValueError):
+            listbalancer.scale_weights(np.array([1, 2]), 0)